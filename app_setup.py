@@ -8,6 +8,7 @@ import redis
 from magplex import Locale
 from magplex.database.database import PostgresConnection, PostgresPool, RedisPool
 from magplex.database.migrations import migrations
+from magplex.device.manager import DeviceManager
 from magplex.utilities import logs
 from magplex.utilities.scheduler import TaskManager, wake_scheduler
 from magplex.utilities.variables import Environment
@@ -54,7 +55,6 @@ def initialize():
     logging.info("Creating Postgres database schema if it doesn't already exist.")
     migrations.create_database()
     migrations.run_missing_migrations()
-    # TODO: Initialize all devices on startup, and add their background tasks to the queue.
     PostgresPool.close_pool()
 
 
@@ -64,5 +64,9 @@ def run_scheduler():
     scheduler.remove_all_jobs()
     scheduler.add_job(wake_scheduler, 'interval', id="wake_scheduler", seconds=5, replace_existing=True)
     logging.info(Locale.TASK_JOB_ADDED_SUCCESSFULLY(job="wake_scheduler"))
+
+    # Add the background tasks of all devices to the queue, each worker builds the devices themselves.
+    DeviceManager.schedule_tasks()
+    PostgresPool.close_pool()  # Don't share pooled connections with forked workers.
     if not scheduler.running:
         scheduler.start()
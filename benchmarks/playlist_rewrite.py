@@ -0,0 +1,60 @@
+"""Compares the line rewriter against the m3u8 object model on a 1,000 segment playlist.
+
+Usage: python -m benchmarks.playlist_rewrite [segments] [iterations]
+"""
+import sys
+import timeit
+import uuid
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from magplex.device import parser
+from magplex.device.device import Device
+
+
+class BenchmarkDevice:
+    get_device_encryption_key = Device.get_device_encryption_key
+    encrypt_data = Device.encrypt_data
+
+    def __init__(self):
+        self.device_uid = str(uuid.uuid4())
+        self.cipher = AESGCM(self.get_device_encryption_key())
+
+
+class PlainDevice:
+    """Skips encryption, to measure the playlist handling on its own."""
+    device_uid = str(uuid.uuid4())
+
+    @staticmethod
+    def encrypt_data(data):
+        return data['path']
+
+
+def build_playlist(segments):
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:6', '#EXT-X-MEDIA-SEQUENCE:1000']
+    for index in range(segments):
+        lines.append('#EXTINF:6.006,')
+        lines.append(f'segments/{1000 + index}.ts?token=0123456789abcdef')
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    segments = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    content = build_playlist(segments)
+    args = ('http://cdn.example.com/live/', 1234, 'sid')
+
+    print(f'{segments} segments, best of 5 x {iterations} iterations')
+    for name, user_device in (('encrypted', BenchmarkDevice()), ('plain', PlainDevice())):
+        results = {}
+        for method in ('_parse_video_playlist_m3u8', 'rewrite_video_playlist'):
+            rewrite = getattr(parser, method)
+            timer = timeit.Timer(lambda: rewrite(user_device, 1, *args, content).dumps())
+            results[method] = min(timer.repeat(repeat=5, number=iterations)) / iterations * 1000
+
+        m3u8_ms, rewrite_ms = results['_parse_video_playlist_m3u8'], results['rewrite_video_playlist']
+        print(f'{name:>9}: m3u8 {m3u8_ms:8.2f} ms, line rewriter {rewrite_ms:8.2f} ms, {m3u8_ms / rewrite_ms:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
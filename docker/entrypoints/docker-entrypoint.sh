@@ -4,14 +4,22 @@ set -e
 # Substitute environment variables in nginx template
 export STB_PORT="${STB_PORT:-34400}"
 export WEB_PORT="${WEB_PORT:-8080}"
-envsubst '${STB_PORT} ${WEB_PORT}' < /etc/nginx/templates/nginx.conf.template > /etc/nginx/conf.d/default.conf
+export GATEWAY_PORT="${GATEWAY_PORT:-8001}"
+export SEGMENT_CACHE_DIR="${SEGMENT_CACHE_DIR:-/dev/shm/magplex/segments}"
+envsubst '${STB_PORT} ${WEB_PORT} ${GATEWAY_PORT} ${SEGMENT_CACHE_DIR}' < /etc/nginx/templates/nginx.conf.template > /etc/nginx/conf.d/default.conf
 
 # Link nginx logs to stdout/stderr
 ln -sf /dev/stdout /var/log/nginx/access.log
 ln -sf /dev/stderr /var/log/nginx/error.log
 
+# Cached segments are sent by nginx from the segment cache directory.
+export SEGMENT_ACCEL_REDIRECT="${SEGMENT_ACCEL_REDIRECT:-true}"
+
 # Start nginx in background.
 nginx
 
+# Start the streaming gateway in background, it serves the long-lived stream routes.
+python gateway.py &
+
 # Run gunicorn in the foreground.
 exec gunicorn -c docker/scripts/gunicorn.conf.py main:app
@@ -2,6 +2,7 @@ import multiprocessing
 
 from app_setup import initialize, run_scheduler
 from magplex.database.database import PostgresPool
+from magplex.device.manager import DeviceManager
 
 # Configuration
 MAX_PG_CONNECTIONS = 100
@@ -38,3 +39,6 @@ def post_fork(server, worker):
 
     # Create a new thread pool per worker.
     PostgresPool.connect()
+
+    # Initialize all devices, so the first requests after a deploy don't have to.
+    DeviceManager.prewarm()
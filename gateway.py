@@ -0,0 +1,18 @@
+import logging
+import sys
+
+from aiohttp import web
+
+from magplex.gateway import create_gateway
+from magplex.utilities import logs
+from magplex.utilities.variables import Environment
+from version import version
+
+if __name__ == '__main__':
+    logs.initialize()
+    if not Environment.valid():
+        logging.error("Missing environment variables.")
+        sys.exit()
+
+    logging.info(f"MagPlex v{version} streaming gateway listening on port {Environment.GATEWAY_PORT}.")
+    web.run_app(create_gateway(), host='127.0.0.1', port=Environment.GATEWAY_PORT, access_log=None, print=None)
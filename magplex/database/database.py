@@ -1,4 +1,8 @@
 import logging
+import os
+import threading
+import time
+from collections import Counter
 
 import psycopg
 import psycopg_pool
@@ -63,10 +67,17 @@ class PostgresConnection:
 
 class PostgresPool:
     _pool = None
+    _pid = None
     _min_size = 4
     _max_size = 100
     _pool_name = None
 
+    # Connection checkout durations, in seconds, counted against the smallest bucket they fit.
+    CHECKOUT_BUCKETS = (0.01, 0.1, 1, 10, 60)
+    _checkouts = {}
+    _checkout_stats = Counter()
+    _checkout_lock = threading.Lock()
+
     @classmethod
     def set_min_size(cls, min_size):
         cls._min_size = min_size
@@ -81,20 +92,57 @@ class PostgresPool:
 
     @classmethod
     def get_connection(cls):
-        if cls._pool is None:
+        if cls._pool is None or cls._pid != os.getpid():
             cls.connect()
-        return cls._pool.getconn()
+        conn = cls._pool.getconn()
+        with cls._checkout_lock:
+            cls._checkouts[id(conn)] = time.monotonic()
+        return conn
 
 
     @classmethod
     def put_connection(cls, conn):
+        with cls._checkout_lock:
+            checked_out_at = cls._checkouts.pop(id(conn), None)
+            if checked_out_at is not None:
+                duration = time.monotonic() - checked_out_at
+                bucket = next((f'le_{b}s' for b in cls.CHECKOUT_BUCKETS if duration <= b), 'gt_60s')
+                cls._checkout_stats['checkouts'] += 1
+                cls._checkout_stats[bucket] += 1
+                cls._checkout_stats['total_ms'] += int(duration * 1000)
+                cls._checkout_stats['max_ms'] = max(cls._checkout_stats['max_ms'], int(duration * 1000))
         if cls._pool is not None:
             cls._pool.putconn(conn)
 
 
+    @classmethod
+    def get_stats(cls):
+        """Connection checkout durations for this process, connections held by a stream show up as in use."""
+        now = time.monotonic()
+        with cls._checkout_lock:
+            stats = dict(cls._checkout_stats)
+            in_use = list(cls._checkouts.values())
+        checkouts = stats.pop('checkouts', 0)
+        return {
+            'pool': cls._pool_name,
+            'in_use': len(in_use),
+            'longest_in_use_ms': int((now - min(in_use)) * 1000) if in_use else 0,
+            'checkouts': checkouts,
+            'mean_checkout_ms': stats.pop('total_ms', 0) // checkouts if checkouts else 0,
+            'max_checkout_ms': stats.pop('max_ms', 0),
+            'buckets': {bucket: stats.get(bucket, 0) for bucket in
+                        [f'le_{b}s' for b in cls.CHECKOUT_BUCKETS] + ['gt_60s']},
+            'pool_stats': cls._pool.get_stats() if cls._pool is not None else {}
+        }
+
+
     @classmethod
     def connect(cls):
-        if cls._pool is None:
+        """Opens the pool, a pool inherited through a fork is left to the parent process."""
+        if cls._pool is None or cls._pid != os.getpid():
+            with cls._checkout_lock:
+                cls._checkouts.clear()
+                cls._checkout_stats.clear()
             conninfo = (
                 f"postgresql://{Environment.POSTGRES_USER}:"
                 f"{Environment.POSTGRES_PASSWORD}@"
@@ -110,9 +158,12 @@ class PostgresPool:
                 max_lifetime=900,
                 max_idle=60
             )
+            cls._pid = os.getpid()
 
     @classmethod
     def close_pool(cls):
+        with cls._checkout_lock:
+            cls._checkouts.clear()
         if cls._pool:
             cls._pool.close()
             pool = cls._pool
@@ -1,11 +1,12 @@
-import logging
-import sys
+from dataclasses import dataclass
 from functools import wraps
 from http import HTTPStatus
+from uuid import UUID
 
 from flask import g, redirect, request
 
 from magplex import PostgresConnection, users
+from magplex.users.database import UserSession
 from magplex.utilities.error import ErrorResponse
 from magplex.utilities.localization import Locale
 
@@ -16,63 +17,50 @@ class AuthMethod:
     ALL = 'all'
 
 
+@dataclass(slots=True)
+class Authentication:
+    user_uid: UUID
+    device_uid: UUID | None
+    user_session: UserSession | None = None
+
+
+def authenticate(auth_method, api_key=None, session_uid=None):
+    """Gets the user from an API key or a session, returns None when neither is valid for the auth method."""
+    authentication = None
+    if api_key and auth_method in (AuthMethod.API, AuthMethod.ALL):
+        with PostgresConnection() as conn:
+            user_profile = users.database.validate_api_key(conn, api_key)
+            if user_profile:
+                user_device_profile = users.database.get_device_profile_by_user(conn, user_profile.user_uid)
+                device_uid = user_device_profile.device_uid if user_device_profile else None
+                authentication = Authentication(user_profile.user_uid, device_uid)
+
+    if session_uid and auth_method in (AuthMethod.SESSION, AuthMethod.ALL):
+        with PostgresConnection() as conn:
+            user_session = users.database.get_user_session(conn, session_uid)
+            if user_session is not None:
+                user_device_profile = users.database.get_device_profile_by_user(conn, user_session.user_uid)
+                device_uid = user_device_profile.device_uid if user_device_profile else None
+                authentication = Authentication(user_session.user_uid, device_uid, user_session)
+
+    return authentication
+
+
 def authorize_route(*, auth_method=AuthMethod.ALL, force_redirect=False):
     def decorator(func):
         @wraps(func)
         def decorated(*args, **kwargs):
-            # Attempt to get the user from an API key.
-            user_authenticated = False
-            api_key = request.headers.get('X-Api-Key')
-            if api_key and auth_method in (AuthMethod.API, AuthMethod.ALL):
-                with PostgresConnection() as conn:
-                    user_profile = users.database.validate_api_key(conn, api_key)
-                    if user_profile:
-                        g.user_uid = user_profile.user_uid
-                        user_device_profile = users.database.get_device_profile_by_user(conn, user_profile.user_uid)
-                        g.device_uid = user_device_profile.device_uid if user_device_profile else None
-                        user_authenticated = True
-
-            # Attempt to get the user from a session.
-            session_uid = request.cookies.get('session_uid')
-            if session_uid and auth_method in (AuthMethod.SESSION, AuthMethod.ALL):
-                with PostgresConnection() as conn:
-                    user_session = users.database.get_user_session(conn, session_uid)
-                    if user_session is not None:
-                        g.user_session = user_session
-                        g.user_uid = user_session.user_uid
-                        user_device_profile = users.database.get_device_profile_by_user(conn, user_session.user_uid)
-                        g.device_uid = user_device_profile.device_uid if user_device_profile else None
-                        user_authenticated = True
-
-            if not user_authenticated:
+            authentication = authenticate(auth_method, request.headers.get('X-Api-Key'), request.cookies.get('session_uid'))
+            if authentication is None:
                 if force_redirect:
                     return redirect('/login')
                 else:
                     return ErrorResponse(Locale.GENERAL_INVALID_CREDENTIALS, HTTPStatus.FORBIDDEN)
 
+            g.user_uid = authentication.user_uid
+            g.device_uid = authentication.device_uid
+            if authentication.user_session is not None:
+                g.user_session = authentication.user_session
             return func(*args, **kwargs)
         return decorated
     return decorator
-
-
-
-def limit_recursion(max_depth):
-    """Decorator that returns None after reaching max recursion depth."""
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            # Count only frames belonging to this function
-            frame = sys._getframe()
-            code = func.__code__
-            depth = 0
-            while frame:
-                if frame.f_code is code:
-                    depth += 1
-                frame = frame.f_back
-            logging.debug(f"[{func.__name__}] recursion level ({depth}).")
-            if depth > max_depth:
-                logging.debug(f"[{func.__name__}] Reached recursion limit ({max_depth}), returning None.")
-                return None
-            return func(*args, **kwargs)
-        return wrapper
-    return decorator
\ No newline at end of file
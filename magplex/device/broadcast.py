@@ -0,0 +1,356 @@
+import asyncio
+import logging
+import subprocess
+import threading
+import uuid
+from collections import deque
+from collections.abc import Callable
+from dataclasses import dataclass
+from http import HTTPStatus
+
+from magplex.database.database import RedisPool
+from magplex.device import cache, media
+from magplex.utilities.events import EventBus
+from magplex.utilities.localization import Locale
+from magplex.utilities.media import MediaClient
+from magplex.utilities.variables import Environment
+
+TS_PACKET_SIZE = 188
+CHUNK_SIZE = TS_PACKET_SIZE * 348  # Chunks hold whole packets, so a client can join at any chunk.
+
+
+@dataclass(slots=True, eq=False)
+class HubCursor:
+    position: int
+    lags: int = 0
+    streak: int = 0  # Chunks read since the last lag.
+    waker: Callable | None = None
+
+
+class ChannelHub:
+    """Runs one ffmpeg for a channel of a device, and fans its output out to every client watching it.
+    The output is kept in a ring buffer which each client reads from its own cursor. A client which falls behind
+    the buffer skips ahead to the live edge, and is dropped if it keeps falling behind. Lags are forgiven once the
+    client has kept up for a while, so only sustained lag drops it.
+    The hub holds a tuner of the device for as long as it runs, shared by all of its clients."""
+    JOIN_BACKLOG = 16  # Chunks a new client starts behind the live edge, so its player buffers quickly.
+    MAX_LAGS = 3
+    LAG_RESET_CHUNKS = 256  # Chunks read without lagging before a client's lags are forgiven.
+    READ_TIMEOUT = 1
+    STOP_TIMEOUT = 5  # Seconds ffmpeg gets to exit after being terminated, before it's killed.
+
+    def __init__(self, key, user_device, stream_id):
+        self.key = key
+        self.user_device = user_device
+        self.stream_id = stream_id
+        self.holder = uuid.uuid4().hex
+        self.idle = False
+        self.buffer = deque(maxlen=max(1, Environment.BROADCAST_BUFFER_SIZE * 1024 * 1024 // CHUNK_SIZE))
+        self.end = 0  # Position after the newest chunk in the buffer.
+        self.cursors = []
+        self.process = None
+        self.closed = False
+        self.close_timer = None
+        self.condition = threading.Condition()
+
+    @property
+    def start(self):
+        return self.end - len(self.buffer)
+
+    def run(self):
+        threading.Thread(target=self._read_stream, name=f'broadcast-{self.key[1]}', daemon=True).start()
+        threading.Thread(target=self._renew_tuner, name=f'broadcast-tuner-{self.key[1]}', daemon=True).start()
+
+    def _renew_tuner(self):
+        conn = RedisPool.get_connection()
+        while not self.closed:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed, timeout=cache.TUNER_RENEW_INTERVAL)
+            if self.closed:
+                return
+            try:
+                renewed = cache.renew_tuner(conn, self.user_device.device_uid, self.key[1], self.holder)
+            except Exception:
+                continue  # The lease outlasts a few failed renewals.
+            if not renewed:
+                logging.warning(Locale.TUNER_LEASE_LOST(device_uid=self.user_device.device_uid, channel=self.key[1]))
+                BroadcastHub.remove_hub(self)
+                self.close()
+
+    def _read_stream(self):
+        logging.info(Locale.BROADCAST_HUB_STARTED(device_uid=self.user_device.device_uid, channel=self.key[1]))
+        encoder = media.get_encoder()
+        try:
+            while not self.closed:
+                channel_url = self.user_device.get_channel_playlist(self.stream_id)
+                if not channel_url:
+                    break
+                r = MediaClient.get(channel_url)
+                if r.status_code != HTTPStatus.OK:
+                    # The cached link was rejected, request a new one.
+                    self.user_device.invalidate_channel_playlist(self.stream_id)
+                    channel_url = self.user_device.get_channel_playlist(self.stream_id)
+                    if not channel_url:
+                        break
+                    r = MediaClient.get(channel_url)
+                headers = ''.join(f"{k}: {v}\r\n" for k, v in r.headers.items() if k in ['X-Sid', 'User-Agent', 'Referer', 'Origin'])
+                process = media.create_stream_response(channel_url, encoder, headers)
+                with self.condition:
+                    self.process = process if not self.closed else None
+                try:
+                    if self.process is not None:
+                        for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b''):
+                            self._push(chunk)
+                finally:
+                    self._stop_process(process)
+                if self.closed:
+                    break
+
+                # The stream ended, the link is likely no longer valid.
+                self.user_device.invalidate_channel_playlist(self.stream_id)
+        except Exception:
+            if not self.closed:
+                logging.exception(Locale.BROADCAST_HUB_FAILED(device_uid=self.user_device.device_uid,
+                                                              channel=self.key[1]))
+        finally:
+            BroadcastHub.remove_hub(self)
+            self.close()
+
+    def _push(self, chunk):
+        with self.condition:
+            self.buffer.append(chunk)
+            self.end += 1
+            self.condition.notify_all()
+            wakers = [cursor.waker for cursor in self.cursors if cursor.waker is not None]
+        for waker in wakers:
+            waker()
+
+    def _stop_process(self, process):
+        with self.condition:
+            if self.process is process:
+                self.process = None
+        try:
+            process.terminate()
+        except Exception:
+            pass
+        threading.Thread(target=self._reap_process, args=(process,), daemon=True).start()
+        try:
+            process.stdout.close()
+        except Exception:
+            pass
+
+    def _reap_process(self, process):
+        try:
+            process.wait(timeout=self.STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def attach(self, waker=None):
+        """Adds a client, async clients pass a waker which is called from the reader thread when output arrives."""
+        with self.condition:
+            if self.closed:
+                return None
+            if self.close_timer is not None:
+                self.close_timer.cancel()
+                self.close_timer = None
+            if self.idle:
+                self.idle = False
+                self._set_tuner_idle(False)
+            cursor = HubCursor(max(self.start, self.end - self.JOIN_BACKLOG), waker=waker)
+            self.cursors.append(cursor)
+            return cursor
+
+    def detach(self, cursor):
+        """Removes a client, the hub closes once it has had no clients for the grace period."""
+        with self.condition:
+            if cursor in self.cursors:
+                self.cursors.remove(cursor)
+            if self.cursors or self.closed:
+                return
+            self.idle = True
+            self._set_tuner_idle(True)
+            self.close_timer = threading.Timer(Environment.BROADCAST_GRACE_PERIOD, self._close_if_idle)
+            self.close_timer.daemon = True
+            self.close_timer.start()
+
+    def _set_tuner_idle(self, idle):
+        try:
+            cache.set_tuner_idle(RedisPool.get_connection(), self.user_device.device_uid, self.key[1], self.holder, idle)
+        except Exception:
+            pass
+
+    def get_clients(self):
+        with self.condition:
+            return len(self.cursors)
+
+    def _close_if_idle(self):
+        if self.close(idle_only=True):
+            BroadcastHub.remove_hub(self)
+
+    def close(self, idle_only=False):
+        """Stops the hub, returns whether it was stopped. With idle_only, a hub that was attached to is left running."""
+        with self.condition:
+            if self.closed or (idle_only and self.cursors):
+                return False
+            self.closed = True
+            if self.close_timer is not None:
+                self.close_timer.cancel()
+            self.condition.notify_all()
+            wakers = [cursor.waker for cursor in self.cursors if cursor.waker is not None]
+            process = self.process
+        if process is not None:
+            # The reader thread sees the end of the output, and cleans up the process.
+            try:
+                process.terminate()
+            except Exception:
+                pass
+        for waker in wakers:
+            waker()
+        try:
+            cache.release_tuner(RedisPool.get_connection(), self.user_device.device_uid, self.key[1], self.holder)
+        except Exception:
+            pass  # The lease expires on its own.
+        logging.info(Locale.BROADCAST_HUB_CLOSED(device_uid=self.user_device.device_uid, channel=self.key[1]))
+        return True
+
+    def _next_chunk(self, cursor):
+        """Returns the next chunk for the cursor, b'' when there's none yet, or None once the client must stop."""
+        if cursor.position < self.start:
+            cursor.lags += 1
+            cursor.streak = 0
+            if cursor.lags > self.MAX_LAGS:
+                logging.warning(Locale.BROADCAST_CLIENT_DROPPED(device_uid=self.user_device.device_uid,
+                                                                channel=self.key[1]))
+                return None
+            logging.info(Locale.BROADCAST_CLIENT_LAGGED(device_uid=self.user_device.device_uid, channel=self.key[1]))
+            cursor.position = max(self.start, self.end - self.JOIN_BACKLOG)
+        if cursor.position < self.end:
+            chunk = self.buffer[cursor.position - self.start]
+            cursor.position += 1
+            if cursor.lags:
+                cursor.streak += 1
+                if cursor.streak >= self.LAG_RESET_CHUNKS:
+                    cursor.lags, cursor.streak = 0, 0
+            return chunk
+        return None if self.closed else b''
+
+    def read(self, cursor):
+        """Blocks until the next chunk for the cursor, returns None once the stream is over for the client."""
+        with self.condition:
+            while (chunk := self._next_chunk(cursor)) == b'':
+                self.condition.wait(self.READ_TIMEOUT)
+            return chunk
+
+    async def read_async(self, cursor, event):
+        """Awaits the next chunk for a cursor attached with a waker setting the event."""
+        while True:
+            with self.condition:
+                chunk = self._next_chunk(cursor)
+                if chunk != b'':
+                    return chunk
+                event.clear()
+            await event.wait()
+
+
+class HubStream:
+    """The hub output for one client, iterated with for or async for. Closing it detaches the client, which also
+    happens if the stream is closed without having been read."""
+    def __init__(self, hub, cursor, event=None):
+        self.hub = hub
+        self.cursor = cursor
+        self.event = event
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self.hub.read(self.cursor) if self.cursor is not None else None
+        if chunk is None:
+            self.close()
+            raise StopIteration
+        return chunk
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.hub.read_async(self.cursor, self.event) if self.cursor is not None else None
+        if chunk is None:
+            self.close()
+            raise StopAsyncIteration
+        return chunk
+
+    def close(self):
+        cursor, self.cursor = self.cursor, None
+        if cursor is not None:
+            self.hub.detach(cursor)
+
+
+class BroadcastHub:
+    """Registry of the channel hubs running in this process, keyed by device and channel."""
+    _hubs = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_hub(cls, user_device, channel):
+        """Gets the running hub of the channel, or starts one on a free tuner. Returns None when every tuner is busy."""
+        key = (user_device.device_uid, channel.channel_id)
+        with cls._lock:
+            hub = cls._hubs.get(key)
+            if hub is not None and not hub.closed:
+                return hub
+            hub = ChannelHub(key, user_device, channel.stream_id)
+            if not cache.acquire_tuner(RedisPool.get_connection(), user_device.device_uid, channel.channel_id,
+                                       hub.holder, Environment.TUNER_COUNT, Environment.TUNER_PREEMPTION):
+                logging.warning(Locale.TUNER_UNAVAILABLE(device_uid=user_device.device_uid, channel=channel.channel_id))
+                return None
+            cls._hubs[key] = hub
+        hub.run()
+        return hub
+
+    @classmethod
+    def open_stream(cls, user_device, channel, loop=None):
+        """Attaches a client to the channel, returns None when every tuner is busy.
+        Async clients pass their event loop, the stream is then read with async for."""
+        event = asyncio.Event() if loop is not None else None
+        waker = (lambda: loop.call_soon_threadsafe(event.set)) if loop is not None else None
+        while True:
+            hub = cls.get_hub(user_device, channel)
+            if hub is None:
+                return None
+            cursor = hub.attach(waker)
+            if cursor is not None:
+                return HubStream(hub, cursor, event)
+
+    @classmethod
+    def remove_hub(cls, hub):
+        with cls._lock:
+            if cls._hubs.get(hub.key) is hub:
+                del cls._hubs[hub.key]
+
+    @classmethod
+    def close_all(cls):
+        """Stops every hub, so no ffmpeg outlives the process."""
+        with cls._lock:
+            hubs = list(cls._hubs.values())
+            cls._hubs.clear()
+        for hub in hubs:
+            hub.close()
+
+    @classmethod
+    def _on_tuner_preempted(cls, message):
+        if message is None:
+            return
+
+        device_uid, channel_id, holder = message.split(':')
+        with cls._lock:
+            hub = cls._hubs.get((device_uid, int(channel_id)))
+            if hub is None or hub.holder != holder:
+                return  # The tuner was held by a hub in another process.
+            del cls._hubs[hub.key]
+        logging.info(Locale.TUNER_PREEMPTED(device_uid=device_uid, channel=channel_id))
+        hub.close()
+
+
+EventBus.subscribe(cache.TUNER_PREEMPTED_EVENT, BroadcastHub._on_tuner_preempted)
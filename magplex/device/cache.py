@@ -1,64 +1,490 @@
-def _get_device_timeout_key(instance_id):
-    return f'magplex:device:{instance_id}:timeout'
+import hashlib
+import time
+import uuid
+from dataclasses import dataclass
+from enum import StrEnum
 
+from magplex.utilities.events import EventBus, get_event_channel
 
-def _get_device_access_token_key(device_uid):
-    return f'magplex:device:{device_uid}:token'
 
+def _get_device_circuit_key(device_uid):
+    return f'magplex:device:{device_uid}:circuit'
 
-def _get_device_access_random_key(device_uid):
-    return f'magplex:device:{device_uid}:random'
 
+def _get_device_circuit_probe_key(device_uid):
+    return f'magplex:device:{device_uid}:circuit_probe'
 
-def _get_device_signature_key(device_uid):
-    return f'magplex:device:{device_uid}:signature'
 
+def _get_device_access_key(device_uid):
+    return f'magplex:device:{device_uid}:access'
 
-def set_device_timeout(conn, instance_id):
-    cache_key = _get_device_timeout_key(instance_id)
-    expiry = 30
-    conn.set(cache_key, int(True), ex=expiry, nx=True)
 
+def _get_device_auth_lock_key(device_uid):
+    return f'magplex:device:{device_uid}:auth_lock'
 
-def get_device_timeout(conn, instance_id):
-    cache_key = _get_device_timeout_key(instance_id)
-    return conn.exists(cache_key)
+
+def _get_channel_link_key(device_uid, stream_id):
+    return f'magplex:device:{device_uid}:link:{stream_id}'
+
+
+def _get_variant_playlist_key(device_uid, channel_id, variant_link):
+    variant_hash = hashlib.sha256(variant_link.encode()).hexdigest()[:32]
+    return f'magplex:device:{device_uid}:variant:{channel_id}:{variant_hash}'
+
+
+def _get_variant_playlist_lock_key(device_uid, channel_id, variant_link):
+    return f'{_get_variant_playlist_key(device_uid, channel_id, variant_link)}:lock'
+
+
+def _get_segment_handle_key(device_uid, handle):
+    return f'magplex:device:{device_uid}:segment:{handle}'
+
+
+def _get_channel_list_mode_key(device_uid):
+    return f'magplex:device:{device_uid}:channel_list_mode'
+
+
+def _get_tuners_key(device_uid):
+    return f'magplex:device:{device_uid}:tuners'
+
+
+def _get_idle_tuners_key(device_uid):
+    return f'magplex:device:{device_uid}:tuners:idle'
 
 
-def get_device_access_token(conn, device_uid):
-    cache_key = _get_device_access_token_key(device_uid)
-    token = conn.get(cache_key)
-    return token
+def _get_portal_rate_limit_key(portal_host):
+    return f'magplex:portal:{portal_host}:bucket'
 
 
-def set_device_access_token(conn, device_uid, token):
-    cache_key = _get_device_access_token_key(device_uid)
-    conn.set(cache_key, token, ex=3600)  # Auto-expire every hour.
+# Token bucket shared by every worker. A token may be reserved ahead of being refilled, up to the caller's debt limit,
+# and the caller is told how long to wait for it. Past the limit nothing is reserved, and the caller is told how long
+# to wait before trying again. Returns whether a token was reserved, and the wait.
+_PORTAL_RATE_LIMIT_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_debt = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1]) or burst
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - timestamp) * rate)
+local reserved = tokens - 1 >= -max_debt
+if reserved then
+    tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'timestamp', now)
+redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+if reserved then
+    return {1, tostring(math.max(0, -tokens) / rate)}
+end
+return {0, tostring((1 - max_debt - tokens) / rate)}
+"""
 
 
-def get_device_access_random(conn, device_uid):
-    cache_key = _get_device_access_random_key(device_uid)
-    token = conn.get(cache_key)
-    return token
+DEVICE_ACCESS_EXPIRY = 3600
+DEVICE_ACCESS_EVENT = 'device_access'
+DEVICE_ACCESS_MAX_AGE = 60  # Upper bound on how long a worker trusts its in-process copy.
 
 
-def set_device_access_random(conn, device_uid, random):
-    cache_key = _get_device_access_random_key(device_uid)
-    conn.set(cache_key, random, ex=3600)
+@dataclass(slots=True)
+class DeviceAccess:
+    token: str | None
+    random: str | None
+    signature: str | None
+    version: str | None
+    expires_at: float
+    circuit_trips: int
+    circuit_open_until: float
+    fetched_at: float
 
+    @property
+    def circuit_state(self):
+        if not self.circuit_trips:
+            return CircuitState.CLOSED
+        if time.monotonic() < self.circuit_open_until:
+            return CircuitState.OPEN
+        return CircuitState.HALF_OPEN
 
-def get_device_signature(conn, device_uid):
-    cache_key = _get_device_signature_key(device_uid)
-    signature = conn.get(cache_key)
-    return signature
+    @property
+    def circuit_retry_in(self):
+        return max(0.0, self.circuit_open_until - time.monotonic())
 
+    @property
+    def expires_in(self):
+        return self.expires_at - time.monotonic() if self.token else -1
 
-def set_device_signature(conn, device_uid, signature):
-    cache_key = _get_device_signature_key(device_uid)
-    conn.set(cache_key, signature, ex=3600)
+    def is_stale(self):
+        now = time.monotonic()
+        return now >= self.expires_at or now - self.fetched_at >= DEVICE_ACCESS_MAX_AGE
+
+
+def get_device_access(conn, device_uid):
+    """Gets the device authorization and circuit breaker state in a single round trip."""
+    access_key = _get_device_access_key(device_uid)
+    circuit_key = _get_device_circuit_key(device_uid)
+    pipe = conn.pipeline(transaction=False)
+    pipe.hgetall(access_key)
+    pipe.pttl(access_key)
+    pipe.hgetall(circuit_key)
+    pipe.time()
+    access, access_ttl, circuit, (seconds, microseconds) = pipe.execute()
+
+    # The circuit is timed with the Redis clock, so every worker agrees on when it half-opens.
+    now = time.monotonic()
+    redis_now = seconds * 1000 + microseconds // 1000
+    open_for = max(0, int(circuit.get('open_until', 0)) - redis_now) / 1000
+    return DeviceAccess(
+        token=access.get('token'),
+        random=access.get('random'),
+        signature=access.get('signature'),
+        version=access.get('version'),
+        expires_at=now + access_ttl / 1000 if access_ttl > 0 else now + DEVICE_ACCESS_MAX_AGE,
+        circuit_trips=int(circuit.get('trips', 0)),
+        circuit_open_until=now + open_for,
+        fetched_at=now
+    )
+
+
+def set_device_access(conn, device_uid, token, random, signature):
+    """Stores the device authorization state, and notifies every worker holding a stale copy."""
+    cache_key = _get_device_access_key(device_uid)
+    version = uuid.uuid4().hex
+    access = {'token': token, 'random': random, 'signature': signature, 'version': version}
+    pipe = conn.pipeline()
+    pipe.delete(cache_key)
+    pipe.hset(cache_key, mapping={k: v for k, v in access.items() if v is not None})
+    pipe.expire(cache_key, DEVICE_ACCESS_EXPIRY)  # Auto-expire every hour.
+    pipe.publish(get_event_channel(DEVICE_ACCESS_EVENT), f'{device_uid}:{version}')
+    pipe.execute()
+
+    now = time.monotonic()
+    return DeviceAccess(token, random, signature, version, now + DEVICE_ACCESS_EXPIRY, 0, now, now)
 
 
 def expire_device_access(conn, device_uid):
-    access_cache_key = _get_device_access_token_key(device_uid)
-    random_cache_key = _get_device_access_random_key(device_uid)
-    conn.delete(access_cache_key, random_cache_key)
+    cache_key = _get_device_access_key(device_uid)
+    conn.delete(cache_key)
+    EventBus.publish(conn, DEVICE_ACCESS_EVENT, device_uid)
+
+
+class CircuitState(StrEnum):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+
+CIRCUIT_FAILURE_THRESHOLD = 3  # Failed requests within the failure window before a closed circuit opens.
+CIRCUIT_FAILURE_WINDOW = 60
+CIRCUIT_BASE_WINDOW = 5  # The open window doubles on every trip, until the circuit closes again.
+CIRCUIT_MAX_WINDOW = 600
+CIRCUIT_PROBE_EXPIRY = 30
+
+
+# Counts a failure, and opens the circuit once it's over the threshold. A failure while half-open, or a forced one,
+# opens it straight away for an escalated window. Returns the open window in seconds, or 0 if it didn't open.
+_TRIP_CIRCUIT_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local base_window = tonumber(ARGV[1])
+local max_window = tonumber(ARGV[2])
+local threshold = tonumber(ARGV[3])
+local failure_window = tonumber(ARGV[4])
+local force = tonumber(ARGV[5])
+
+if tonumber(redis.call('HGET', KEYS[1], 'open_until') or '0') > now then
+    return '0'
+end
+
+local trips = tonumber(redis.call('HGET', KEYS[1], 'trips') or '0')
+local failures = redis.call('HINCRBY', KEYS[1], 'failures', 1)
+if trips == 0 and failures < threshold and force == 0 then
+    redis.call('PEXPIRE', KEYS[1], math.floor(failure_window * 1000))
+    return '0'
+end
+
+trips = trips + 1
+local window = math.min(base_window * 2 ^ (trips - 1), max_window)
+redis.call('HSET', KEYS[1], 'trips', trips, 'failures', 0, 'open_until', math.floor(now + window * 1000))
+redis.call('PEXPIRE', KEYS[1], math.floor((window + max_window) * 1000))
+redis.call('DEL', KEYS[2])
+return tostring(window)
+"""
+
+
+def trip_device_circuit(conn, device_uid, force=False):
+    """Records a failed request, returning the seconds the circuit was opened for, or 0 if it wasn't opened."""
+    circuit_key = _get_device_circuit_key(device_uid)
+    probe_key = _get_device_circuit_probe_key(device_uid)
+    script = conn.register_script(_TRIP_CIRCUIT_SCRIPT)
+    window = float(script(keys=[circuit_key, probe_key], args=[CIRCUIT_BASE_WINDOW, CIRCUIT_MAX_WINDOW,
+                                                               CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_FAILURE_WINDOW,
+                                                               int(force)]))
+    if window:
+        EventBus.publish(conn, DEVICE_ACCESS_EVENT, device_uid)
+    return window
+
+
+def close_device_circuit(conn, device_uid):
+    circuit_key = _get_device_circuit_key(device_uid)
+    probe_key = _get_device_circuit_probe_key(device_uid)
+    pipe = conn.pipeline()
+    pipe.delete(circuit_key, probe_key)
+    pipe.publish(get_event_channel(DEVICE_ACCESS_EVENT), device_uid)
+    pipe.execute()
+
+
+def acquire_device_circuit_probe(conn, device_uid):
+    """Only one request across all workers may probe a half-open circuit."""
+    cache_key = _get_device_circuit_probe_key(device_uid)
+    return bool(conn.set(cache_key, int(True), ex=CIRCUIT_PROBE_EXPIRY, nx=True))
+
+
+DEVICE_PROFILE_EVENT = 'device_profile'
+DEVICE_PROFILE_MAX_AGE = 300
+
+
+def expire_device_profile(conn, device_uid):
+    """Notifies every worker that the device profile has been saved or deleted."""
+    EventBus.publish(conn, DEVICE_PROFILE_EVENT, str(device_uid))
+
+
+CHANNEL_INDEX_EVENT = 'channel_index'
+CHANNEL_INDEX_MAX_AGE = 300
+
+
+def expire_channel_index(conn, device_uid):
+    """Notifies every worker that the device channels have been saved."""
+    EventBus.publish(conn, CHANNEL_INDEX_EVENT, str(device_uid))
+
+
+CHANNEL_LINK_EXPIRY = 30
+CHANNEL_LINK_FAULT_EXPIRY = 10
+CHANNEL_LINK_FAULT = ''  # Negative cache entry, the portal has no link for the stream.
+
+
+def get_channel_link(conn, device_uid, stream_id):
+    cache_key = _get_channel_link_key(device_uid, stream_id)
+    return conn.get(cache_key)
+
+
+def set_channel_link(conn, device_uid, stream_id, stream_link):
+    cache_key = _get_channel_link_key(device_uid, stream_id)
+    conn.set(cache_key, stream_link, ex=CHANNEL_LINK_EXPIRY)
+
+
+def set_channel_link_fault(conn, device_uid, stream_id):
+    cache_key = _get_channel_link_key(device_uid, stream_id)
+    conn.set(cache_key, CHANNEL_LINK_FAULT, ex=CHANNEL_LINK_FAULT_EXPIRY)
+
+
+def expire_channel_link(conn, device_uid, stream_id):
+    cache_key = _get_channel_link_key(device_uid, stream_id)
+    conn.delete(cache_key)
+
+
+VARIANT_PLAYLIST_TTL_FRACTION = 0.5  # Of the target duration, players poll about once per target duration.
+VARIANT_PLAYLIST_LOCK_EXPIRY = 5
+
+
+def get_variant_playlist(conn, device_uid, channel_id, variant_link):
+    cache_key = _get_variant_playlist_key(device_uid, channel_id, variant_link)
+    return conn.get(cache_key)
+
+
+def set_variant_playlist(conn, device_uid, channel_id, variant_link, playlist, expiry):
+    cache_key = _get_variant_playlist_key(device_uid, channel_id, variant_link)
+    conn.set(cache_key, playlist, px=max(1, int(expiry * 1000)))
+
+
+def acquire_variant_playlist_lock(conn, device_uid, channel_id, variant_link, owner):
+    cache_key = _get_variant_playlist_lock_key(device_uid, channel_id, variant_link)
+    return bool(conn.set(cache_key, owner, ex=VARIANT_PLAYLIST_LOCK_EXPIRY, nx=True))
+
+
+def release_variant_playlist_lock(conn, device_uid, channel_id, variant_link, owner):
+    cache_key = _get_variant_playlist_lock_key(device_uid, channel_id, variant_link)
+    script = conn.register_script(_RELEASE_LOCK_SCRIPT)
+    script(keys=[cache_key], args=[owner])
+
+
+SEGMENT_HANDLE_EXPIRY = 300  # Comfortably longer than a segment stays in a live playlist.
+
+
+def set_segment_handles(conn, device_uid, segments):
+    """Registers the segment handles in a single round trip, segments maps each handle to its data."""
+    pipe = conn.pipeline(transaction=False)
+    for handle, data in segments.items():
+        pipe.set(_get_segment_handle_key(device_uid, handle), data, ex=SEGMENT_HANDLE_EXPIRY)
+    pipe.execute()
+
+
+def get_segment_handle(conn, device_uid, handle):
+    cache_key = _get_segment_handle_key(device_uid, handle)
+    return conn.get(cache_key)
+
+
+CHANNEL_LIST_MODE_EXPIRY = 86400  # The full listing is tried again once the paged mode expires.
+CHANNEL_LIST_PAGED = 'paged'
+
+
+def get_channel_list_mode(conn, device_uid):
+    cache_key = _get_channel_list_mode_key(device_uid)
+    return conn.get(cache_key)
+
+
+def set_channel_list_mode(conn, device_uid, mode):
+    cache_key = _get_channel_list_mode_key(device_uid)
+    conn.set(cache_key, mode, ex=CHANNEL_LIST_MODE_EXPIRY)
+
+
+DEVICE_AUTH_LOCK_EXPIRY = 30
+PORTAL_RATE_MAX_WAIT = 2  # Seconds an interactive request may queue for its token, background requests don't queue.
+
+
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def acquire_device_auth_lock(conn, device_uid, owner):
+    cache_key = _get_device_auth_lock_key(device_uid)
+    return bool(conn.set(cache_key, owner, ex=DEVICE_AUTH_LOCK_EXPIRY, nx=True))
+
+
+def get_device_auth_lock(conn, device_uid):
+    cache_key = _get_device_auth_lock_key(device_uid)
+    return conn.exists(cache_key)
+
+
+def release_device_auth_lock(conn, device_uid, owner):
+    """Releases the lock only if it's still held by the owner, it may have expired and been taken over."""
+    cache_key = _get_device_auth_lock_key(device_uid)
+    script = conn.register_script(_RELEASE_LOCK_SCRIPT)
+    script(keys=[cache_key], args=[owner])
+
+
+def reserve_portal_request(conn, portal_host, rate, burst, max_wait=0):
+    """Reserves a request from the portal host token bucket, waiting at most max_wait seconds for its token.
+    Returns whether it was reserved, and the seconds to wait before sending it, or before trying again if it wasn't."""
+    cache_key = _get_portal_rate_limit_key(portal_host)
+    script = conn.register_script(_PORTAL_RATE_LIMIT_SCRIPT)
+    reserved, delay = script(keys=[cache_key], args=[rate, burst, max_wait * rate])
+    return bool(reserved), float(delay)
+
+
+TUNER_LEASE_EXPIRY = 30
+TUNER_RENEW_INTERVAL = 10
+TUNER_PREEMPTED_EVENT = 'tuner_preempted'
+
+
+# Tuners are leased by channel hubs, as '<channel_id>:<holder>' members scored by their lease expiry. Every hub runs
+# its own upstream connection, so it holds a tuner of its own, even when a hub in another process is tuned to the same
+# channel. When every tuner is busy, a hub with no clients may be preempted. Returns whether a tuner was leased, and
+# the preempted member if any.
+_ACQUIRE_TUNER_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local tuner_count = tonumber(ARGV[1])
+local member = ARGV[2]
+local lease = tonumber(ARGV[3]) * 1000
+local preempt = tonumber(ARGV[4])
+
+for _, expired in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now)) do
+    redis.call('SREM', KEYS[2], expired)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+
+local preempted = ''
+local held = redis.call('ZRANGE', KEYS[1], 0, -1)
+if #held >= tuner_count then
+    if preempt == 0 then
+        return {0, ''}
+    end
+    for _, held_member in ipairs(held) do
+        if redis.call('SISMEMBER', KEYS[2], held_member) == 1 then
+            preempted = held_member
+            break
+        end
+    end
+    if preempted == '' then
+        return {0, ''}
+    end
+    redis.call('ZREM', KEYS[1], preempted)
+    redis.call('SREM', KEYS[2], preempted)
+end
+
+redis.call('ZADD', KEYS[1], now + lease, member)
+redis.call('PEXPIRE', KEYS[1], lease)
+redis.call('PEXPIRE', KEYS[2], lease)
+return {1, preempted}
+"""
+
+
+# Extends a lease which is still held, returns 0 when it has expired or been preempted.
+_RENEW_TUNER_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local lease = tonumber(ARGV[2]) * 1000
+redis.call('ZADD', KEYS[1], now + lease, ARGV[1])
+redis.call('PEXPIRE', KEYS[1], lease)
+redis.call('PEXPIRE', KEYS[2], lease)
+return 1
+"""
+
+
+def acquire_tuner(conn, device_uid, channel_id, holder, tuner_count, preempt=False):
+    """Leases a tuner for a channel hub, returns False when every tuner of the device is busy."""
+    tuners_key = _get_tuners_key(device_uid)
+    idle_key = _get_idle_tuners_key(device_uid)
+    script = conn.register_script(_ACQUIRE_TUNER_SCRIPT)
+    acquired, preempted = script(keys=[tuners_key, idle_key], args=[tuner_count, f'{channel_id}:{holder}',
+                                                                    TUNER_LEASE_EXPIRY, int(preempt)])
+    if preempted:
+        # The message is '<device_uid>:<channel_id>:<holder>', only the preempted hub closes.
+        EventBus.publish(conn, TUNER_PREEMPTED_EVENT, f'{device_uid}:{preempted}')
+    return bool(int(acquired))
+
+
+def renew_tuner(conn, device_uid, channel_id, holder):
+    tuners_key = _get_tuners_key(device_uid)
+    idle_key = _get_idle_tuners_key(device_uid)
+    script = conn.register_script(_RENEW_TUNER_SCRIPT)
+    return bool(int(script(keys=[tuners_key, idle_key], args=[f'{channel_id}:{holder}', TUNER_LEASE_EXPIRY])))
+
+
+def release_tuner(conn, device_uid, channel_id, holder):
+    pipe = conn.pipeline()
+    pipe.zrem(_get_tuners_key(device_uid), f'{channel_id}:{holder}')
+    pipe.srem(_get_idle_tuners_key(device_uid), f'{channel_id}:{holder}')
+    pipe.execute()
+
+
+def set_tuner_idle(conn, device_uid, channel_id, holder, idle):
+    """Marks a hub without clients, the tuner may then be preempted by another channel."""
+    idle_key = _get_idle_tuners_key(device_uid)
+    if idle:
+        pipe = conn.pipeline()
+        pipe.sadd(idle_key, f'{channel_id}:{holder}')
+        pipe.expire(idle_key, TUNER_LEASE_EXPIRY)
+        pipe.execute()
+    else:
+        conn.srem(idle_key, f'{channel_id}:{holder}')
+
+
+def get_tuners(conn, device_uid):
+    """Gets the channel of each leased tuner of the device, and whether its hub is idle, ordered by channel."""
+    seconds, microseconds = conn.time()
+    now = seconds * 1000 + microseconds // 1000
+    pipe = conn.pipeline()
+    pipe.zrangebyscore(_get_tuners_key(device_uid), now, '+inf')
+    pipe.smembers(_get_idle_tuners_key(device_uid))
+    members, idle_members = pipe.execute()
+
+    return sorted((int(member.partition(':')[0]), member in idle_members) for member in members)
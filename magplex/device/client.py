@@ -0,0 +1,120 @@
+import asyncio
+import os
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import BinaryIO
+from urllib.parse import urlparse
+
+import aiohttp
+
+from magplex.utilities.variables import Environment
+
+
+@dataclass(slots=True)
+class PortalResponse:
+    url: str
+    status_code: int
+    content: bytes | None
+    stream: BinaryIO | None = None  # Set instead of content when a large body was spooled to disk.
+
+    @property
+    def text(self):
+        return self.content.decode(errors='replace') if self.content is not None else ''
+
+
+class PortalClient:
+    """Process-wide asyncio engine used for portal requests, with a sync facade for threaded callers."""
+    SPOOL_MAX_SIZE = 1024 * 1024
+    SPOOL_CHUNK_SIZE = 64 * 1024
+    RUN_TIMEOUT = 120  # Seconds a request thread waits on the portal event loop before giving up.
+    _loop = None
+    _thread = None
+    _pid = None
+    _semaphores = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_loop(cls):
+        """Lazily start the event loop thread, recreating it after a fork."""
+        with cls._lock:
+            if cls._loop is None or cls._pid != os.getpid():
+                cls._loop = asyncio.new_event_loop()
+                cls._pid = os.getpid()
+                cls._semaphores = {}
+                cls._thread = threading.Thread(target=cls._loop.run_forever, name='portal-client', daemon=True)
+                cls._thread.start()
+        return cls._loop
+
+    @classmethod
+    def submit(cls, coro):
+        """Schedule a coroutine on the portal event loop, returning a concurrent future for its result."""
+        loop = cls.get_loop()
+        if threading.current_thread() is cls._thread:
+            coro.close()
+            raise RuntimeError('Cannot block on the portal event loop from within itself.')
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+
+    @classmethod
+    def run(cls, coro, timeout=RUN_TIMEOUT):
+        """Run a coroutine on the portal event loop and block until it completes.
+        Raises TimeoutError and cancels the coroutine if it doesn't complete within the timeout."""
+        future = cls.submit(coro)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    @classmethod
+    def create_session(cls):
+        """Creates a client session bound to the portal event loop, each device keeps its own cookies."""
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=Environment.PORTAL_CONCURRENCY, ttl_dns_cache=300)
+        return aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.CookieJar(unsafe=True))
+
+    @classmethod
+    def close_session(cls, session):
+        """Close a client session from any thread."""
+        if session is None or session.closed:
+            return
+        loop = cls.get_loop()
+        if threading.current_thread() is cls._thread:
+            loop.create_task(session.close())
+        else:
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+
+    @classmethod
+    def _get_semaphore(cls, host):
+        semaphore = cls._semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(Environment.PORTAL_CONCURRENCY)
+            cls._semaphores[host] = semaphore
+        return semaphore
+
+    @classmethod
+    async def fetch(cls, session, url, headers=None, cookies=None, timeout=15, spool=False):
+        """Performs a GET request, limiting the number of in-flight requests per portal host.
+        When spooling, bodies larger than SPOOL_MAX_SIZE are written to a temporary file instead of memory."""
+        host = urlparse(url).hostname
+        async with cls._get_semaphore(host):
+            client_timeout = aiohttp.ClientTimeout(total=timeout)
+            async with session.get(url, headers=headers, cookies=cookies, timeout=client_timeout) as response:
+                if not spool:
+                    content = await response.read()
+                    return PortalResponse(str(response.url), response.status, content)
+
+                stream = tempfile.SpooledTemporaryFile(max_size=cls.SPOOL_MAX_SIZE)
+                try:
+                    async for chunk in response.content.iter_chunked(cls.SPOOL_CHUNK_SIZE):
+                        stream.write(chunk)
+                    size = stream.tell()
+                    stream.seek(0)
+                    if size <= cls.SPOOL_MAX_SIZE:
+                        content = stream.read()
+                        stream.close()
+                        return PortalResponse(str(response.url), response.status, content)
+                    stream.flush()
+                    return PortalResponse(str(response.url), response.status, None, stream)
+                except BaseException:
+                    stream.close()
+                    raise
@@ -28,6 +28,14 @@ class Channel:
     creation_timestamp: datetime | None
 
 
+@dataclass(slots=True)
+class ChannelIndexEntry:
+    channel_id: int
+    stream_id: int
+    channel_enabled: bool | None
+    channel_stale: bool | None
+
+
 @dataclass(slots=True)
 class ChannelGuide:
     device_uid: UUID
@@ -145,6 +153,17 @@ def get_channel(conn, device_uid, channel_id):
         return None
 
 
+def get_channel_index(conn, device_uid):
+    with conn.cursor() as cursor:
+        query = """
+            select channel_id, stream_id, channel_enabled, channel_stale
+            from channels
+            where device_uid = %(device_uid)s
+        """
+        cursor.execute(query, locals())
+        return {row[0]: ChannelIndexEntry(*row) for row in cursor}
+
+
 def get_channels(conn, device_uid, channel_enabled=None, channel_stale=None, genre_id=None, q=None):
     with conn.cursor() as cursor:
         query = """
@@ -1,35 +1,57 @@
+import asyncio
 import base64
+import binascii
+import concurrent.futures
+import functools
 import hashlib
 import json
 import logging
 import os
+import time
 import uuid
-from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime, timezone
 from http import HTTPStatus
+from itertools import batched, islice
 from urllib.parse import urlparse
 
-import requests
-from apscheduler.jobstores.base import ConflictingIdError
+import aiohttp
+import orjson
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from requests import ReadTimeout
-from requests.adapters import HTTPAdapter
 
 from magplex import users
 from magplex.database.database import PostgresConnection, RedisPool
-from magplex.decorators import limit_recursion
-from magplex.device import cache, tasks
+from magplex.device import cache, database, parser, tasks, tokens
+from magplex.device.client import PortalClient
+from magplex.device.retry import Outcome, RetryPolicy, RetryStats
+from magplex.utilities.events import EventBus
 from magplex.utilities.localization import Locale
-from magplex.utilities.scheduler import TaskManager
+from magplex.utilities.variables import Environment
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+INVALID_RESPONSE_MARKERS = ('Authorization failed', 'Access denied', 'device_id mismatch')
+CHANNEL_LIST_SLOW_THRESHOLD = 10  # Seconds, a full listing slower than this switches the device to paged fetching.
+CHANNEL_BATCH_SIZE = 500
+CHANNEL_PAGE_WINDOW = 4  # Channel list pages in flight at once.
+DECRYPT_CACHE_SIZE = 1024
 
 
 class Device:
     def __init__(self, device_uid):
-        self.adapter = HTTPAdapter(pool_connections=100, pool_maxsize=100)
-        self.session = requests.session()
-        self.session.mount("http://", self.adapter)
-        self.session.mount("https://", self.adapter)
+        self.pid = os.getpid()
+        self.session = None
+        self.auth_lock = asyncio.Lock()
+        self.access_state = None
+        self.retry_stats = RetryStats()
+        self.device_profile = None
+        self.device_profile_expires_at = 0
+        self.channel_index = None
+        self.channel_index_expires_at = 0
+        self.channel_index_version = 0
         self.device_uid = device_uid
+        self.cipher = AESGCM(self.get_device_encryption_key())
+        self.decrypt_cache = functools.lru_cache(maxsize=DECRYPT_CACHE_SIZE)(self._decrypt_token)
+        self.last_used = time.monotonic()
         self.signature = None
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Unknown; Linux) AppleWebKit/538.1 (KHTML, like Gecko) MAG200 stbapp ver: 4 rev: 734 Mobile Safari/538.1',
@@ -40,71 +62,152 @@ class Device:
         self.cookies = {
             'stb_lang': f'en',
         }
-        self.get_device_profile()
-        self._schedule_tasks()
+        if self.get_device_profile() is not None:
+            self._schedule_tasks()
 
 
     def _schedule_tasks(self):
-        scheduler = TaskManager.get_scheduler()
-        jobs = {
-            tasks.save_channels: {'hours': 1, 'args': [self.device_uid]},
-            tasks.save_channel_guides: {'hours': 1, 'args': [self.device_uid]}
-        }
+        tasks.schedule_tasks(self.device_uid)
 
-        for job, kwargs in jobs.items():
-            job_name = f'{self.device_uid}:{job.__name__}'
-            try:
-                if scheduler.get_job(job_name) is not None:
-                    continue
-                scheduler.add_job(job, 'interval', id=job_name, next_run_time=datetime.now(timezone.utc), **kwargs)
-                logging.info(Locale.TASK_JOB_ADDED_SUCCESSFULLY(device_uid=self.device_uid, job=job_name))
-            except ConflictingIdError:
-                logging.warning(Locale.TASK_CONFLICTING_JOB_IGNORED(device_uid=self.device_uid, job=job_name))
+
+    def _detach_from_parent(self):
+        """Drops the portal session and lock inherited through a fork, they belong to the parent's event loop."""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.session = None
+            self.auth_lock = asyncio.Lock()
+
+
+    def close(self):
+        """Releases the portal session, a new one is created if the device is used again."""
+        self._detach_from_parent()
+        session, self.session = self.session, None
+        PortalClient.close_session(session)
+
+
+    def _circuit_open(self):
+        circuit_open = self.get_access_state().circuit_state is cache.CircuitState.OPEN
+        if circuit_open:
+            logging.warning(Locale.DEVICE_CIRCUIT_OPEN(device_uid=self.device_uid))
+
+        return circuit_open
+
+
+    def _circuit_allows_request(self):
+        """A closed circuit allows every request, an open one none, and a half-open one a single probe."""
+        circuit_state = self.get_access_state().circuit_state
+        if circuit_state is cache.CircuitState.CLOSED:
+            return True
+
+        cache_conn = RedisPool.get_connection()
+        if circuit_state is cache.CircuitState.HALF_OPEN and cache.acquire_device_circuit_probe(cache_conn, self.device_uid):
+            return True
+
+        logging.warning(Locale.DEVICE_CIRCUIT_OPEN(device_uid=self.device_uid))
+        return False
 
 
-    def _awaiting_timeout(self):
+    def _record_circuit_success(self):
+        if self.get_access_state().circuit_state is not cache.CircuitState.CLOSED:
+            cache_conn = RedisPool.get_connection()
+            cache.close_device_circuit(cache_conn, self.device_uid)
+            self.access_state = None
+            logging.info(Locale.DEVICE_CIRCUIT_CLOSED(device_uid=self.device_uid))
+
+
+    def _record_circuit_failure(self, force=False):
         cache_conn = RedisPool.get_connection()
-        awaiting_timeout = cache.get_device_timeout(cache_conn, self.device_uid)
-        if awaiting_timeout:
-            logging.warning(Locale.DEVICE_AWAITING_TIMEOUT)
+        window = cache.trip_device_circuit(cache_conn, self.device_uid, force)
+        if window:
+            self.access_state = None
+            logging.warning(Locale.DEVICE_CIRCUIT_TRIPPED(device_uid=self.device_uid, seconds=window))
+
 
-        return awaiting_timeout
+    async def _throttle(self, url, background=False):
+        """Waits for the portal host rate limit, which is shared across all workers and devices.
+        Background requests only take tokens which are already available, so they never queue ahead of a viewer."""
+        cache_conn = RedisPool.get_connection()
+        portal_host = urlparse(url).hostname
+        max_wait = 0 if background else cache.PORTAL_RATE_MAX_WAIT
+        while True:
+            reserved, delay = await asyncio.to_thread(cache.reserve_portal_request, cache_conn, portal_host,
+                                                      Environment.PORTAL_RATE_LIMIT, Environment.PORTAL_RATE_BURST,
+                                                      max_wait)
+            if delay > 0:
+                logging.debug(Locale.DEVICE_RATE_LIMITED(device_uid=self.device_uid, delay=round(delay, 3)))
+                await asyncio.sleep(delay)
+            if reserved:
+                return
+
+
+    async def _request(self, url, spool=False, background=False):
+        """Performs a portal request through the shared asyncio client."""
+        await self._throttle(url, background)
+        self._detach_from_parent()
+        if self.session is None or self.session.closed:
+            self.session = PortalClient.create_session()
+        return await PortalClient.fetch(self.session, url, headers=dict(self.headers), cookies=self.cookies,
+                                        timeout=15, spool=spool)
+
+
+    def __reject_response(self, text):
+        logging.warning(Locale.DEVICE_INVALID_RESPONSE_TEXT(device_uid=self.device_uid, text=text))
+        self.headers.pop('Authorization', None)
+        return Outcome.AUTH_FAILURE, None
 
 
-    def __validate_response_text(self, response):
-        invalid_responses = {'Authorization failed', 'Access denied', 'device_id mismatch'}
-        valid_response = True
+    def __parse_response(self, response, path=('js',)):
+        """Parses the response body once and classifies it, returning the payload found at the key path.
+        An invalid authorization still returns a 200 status code, so the payload is checked for error markers."""
         if response.status_code != HTTPStatus.OK:
+            if response.stream is not None:
+                response.stream.close()
             logging.warning(Locale.DEVICE_INVALID_RESPONSE_CODE(device_uid=self.device_uid, status_code=response.status_code))
-            valid_response = False
-        for response_text in invalid_responses:
-            if response_text in response.text:
-                logging.warning(Locale.DEVICE_INVALID_RESPONSE_TEXT(device_uid=self.device_uid, text=response_text))
-                valid_response = False
-        if not valid_response:
             self.headers.pop('Authorization', None)
+            return Outcome.AUTH_FAILURE, None
 
-        return valid_response
+        if response.stream is not None:
+            # Only large listings get spooled to disk, their items are decoded one at a time by the caller.
+            return Outcome.SUCCESS, parser.iter_json_array(response.stream, path)
 
-
-    def __validate_response_json(self, response):
         try:
-            data = json.loads(response.text)
-            if data is None or not isinstance(data, (list, dict)):
-                logging.warning(Locale.DEVICE_RESPONSE_UNEXPECTED_JSON(device_uid=self.device_uid, text=response.text))
-                return False
-        except json.JSONDecodeError:
+            data = orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            # Some failures are answered in plain text, so scan the raw body when it isn't JSON.
+            for marker in INVALID_RESPONSE_MARKERS:
+                if marker.encode() in response.content:
+                    return self.__reject_response(marker)
             logging.warning(Locale.DEVICE_RESPONSE_NOT_JSON(device_uid=self.device_uid, text=response.text))
-            return False
+            return Outcome.INVALID_JSON, None
 
-        return True
+        if not isinstance(data, (list, dict)):
+            logging.warning(Locale.DEVICE_RESPONSE_UNEXPECTED_JSON(device_uid=self.device_uid, text=response.text))
+            return Outcome.INVALID_JSON, None
+
+        if isinstance(data, dict):
+            for value in (data.get('js'), data.get('text'), data.get('error')):
+                if not isinstance(value, str):
+                    continue
+                for marker in INVALID_RESPONSE_MARKERS:
+                    if marker in value:
+                        return self.__reject_response(marker)
+
+        for key in path:
+            data = data.get(key) if isinstance(data, dict) else None
+        return Outcome.SUCCESS, data
 
 
     def get_device_profile(self):
+        """Gets the device profile, kept in-process until it's saved or deleted by any worker."""
+        device_profile = self.device_profile
+        if device_profile is not None and time.monotonic() < self.device_profile_expires_at and EventBus.is_listening():
+            return device_profile
+
         db_conn = PostgresConnection()
         device_profile = users.database.get_device_profile_by_uid(db_conn, self.device_uid)
         db_conn.close()
         if device_profile is None:
+            self.device_profile = None
             logging.warning(Locale.DEVICE_UNAVAILABLE(device_uid=self.device_uid))
             return None
 
@@ -119,49 +222,71 @@ class Device:
             'timezone': f'{device_profile.timezone}'
         })
 
+        self.device_profile = device_profile
+        self.device_profile_expires_at = time.monotonic() + cache.DEVICE_PROFILE_MAX_AGE
         return device_profile
 
 
+    def invalidate_device_profile(self):
+        """Drops the in-process device profile, the next call will query the database."""
+        self.device_profile = None
+
+
+    def get_indexed_channel(self, channel_id):
+        """Gets the stream and state of a channel, from an in-process index kept until any worker saves the channels."""
+        channel_index = self.channel_index
+        if channel_index is None or time.monotonic() >= self.channel_index_expires_at or not EventBus.is_listening():
+            version = self.channel_index_version
+            db_conn = PostgresConnection()
+            channel_index = database.get_channel_index(db_conn, self.device_uid)
+            db_conn.close()
+            # An index loaded while the channels were being saved is used for this request, but not kept.
+            if version == self.channel_index_version:
+                self.channel_index = channel_index
+                self.channel_index_expires_at = time.monotonic() + cache.CHANNEL_INDEX_MAX_AGE
+        return channel_index.get(channel_id)
+
+
+    def invalidate_channel_index(self):
+        """Drops the in-process channel index, the next lookup will query the database."""
+        self.channel_index_version += 1
+        self.channel_index = None
+
+
     def get_device_encryption_key(self):
         """Gets the unique device hash, to be used as an encryption key."""
         return hashlib.sha256(uuid.UUID(self.device_uid).bytes).digest()
 
 
-    def refresh_access_token(self):
+    async def refresh_access_token(self):
         """Gets the authentication token for the session."""
-        awaiting_timeout = self._awaiting_timeout()
-        if awaiting_timeout:
+        if await asyncio.to_thread(self._circuit_open):
             return None
 
-        device_profile = self.get_device_profile()
+        device_profile = await asyncio.to_thread(self.get_device_profile)
         if device_profile is None:
             return None
 
         self.headers.pop('Authorization', None)  # Remove the old authentication header.
         url = f'{device_profile.portal}?type=stb&action=handshake&token=&JsHttpRequest=1-xml'
-        response = self.session.get(url, headers=self.headers, cookies=self.cookies, timeout=15)
+        response = await self._request(url)
 
         # Check for a valid response.
-        valid_response = self.__validate_response_text(response)
-        if not valid_response:
+        outcome, response_data = self.__parse_response(response)
+        if outcome is not Outcome.SUCCESS or not isinstance(response_data, dict):
             return None
 
-        try:
-            response_data = json.loads(response.text).get('js', {})
-            access_token = response_data.get('token')
-            random_token = response_data.get('random')
-            signature = random_token.encode() if random_token else os.urandom(32)
-            signature = hashlib.sha256(signature).hexdigest().upper()
-        except json.JSONDecodeError:
-            return None
+        access_token = response_data.get('token')
+        random_token = response_data.get('random')
+        signature = random_token.encode() if random_token else os.urandom(32)
+        signature = hashlib.sha256(signature).hexdigest().upper()
 
         if not access_token:
             return None
 
         cache_conn = RedisPool.get_connection()
-        cache.set_device_access_token(cache_conn, self.device_uid, access_token)
-        cache.set_device_access_random(cache_conn, self.device_uid, random_token)
-        cache.set_device_signature(cache_conn, self.device_uid, signature)
+        self.access_state = await asyncio.to_thread(cache.set_device_access, cache_conn, self.device_uid, access_token,
+                                                    random_token, signature)
         self.headers['Authorization'] = f'Bearer {access_token}'
         self.signature = signature
         if random_token is not None:
@@ -171,18 +296,54 @@ class Device:
         return access_token
 
 
-    def update_access_token(self):
+    def get_access_state(self, refresh=False):
+        """Gets the authorization state, kept in-process until another worker publishes a change."""
+        access_state = self.access_state
+        if refresh or access_state is None or access_state.is_stale() or not EventBus.is_listening():
+            cache_conn = RedisPool.get_connection()
+            access_state = cache.get_device_access(cache_conn, self.device_uid)
+            self.access_state = access_state
+        return access_state
+
+
+    def invalidate_access_state(self, version=None):
+        """Drops the in-process authorization state, unless it already matches the published version."""
+        access_state = self.access_state
+        if access_state is not None and version is not None and access_state.version == version:
+            return
+        self.access_state = None
+
+
+    def update_access_token(self, refresh=False):
         """Fetch a new access token and update authorization headers."""
-        cache_conn = RedisPool.get_connection()
-        access_token = cache.get_device_access_token(cache_conn, self.device_uid)
+        access_state = self.get_access_state(refresh=refresh)
+        access_token = access_state.token
         if access_token is not None:
             self.headers.update({'Authorization': f'Bearer {access_token}'})
-        self.signature = cache.get_device_signature(cache_conn, self.device_uid)
-        random_token = cache.get_device_access_random(cache_conn, self.device_uid)
+        self.signature = access_state.signature
+        random_token = access_state.random
         if random_token is not None:
             self.headers.update({'X-Random': f'{random_token}'})
             self.headers.update({'Random': f'{random_token}'})
 
+        return access_token
+
+
+    def keep_authorization_alive(self, threshold=900):
+        """Refreshes the authorization ahead of the access token expiring, so requests never pay for it."""
+        access_state = self.get_access_state(refresh=True)
+        if access_state.expires_in > threshold:
+            return True
+        if access_state.circuit_state is not cache.CircuitState.CLOSED:
+            # The half-open probe is left to a request, which records its outcome.
+            return False
+
+        try:
+            return PortalClient.run(self.reauthorize(access_state.token))
+        except TimeoutError:
+            logging.warning(Locale.DEVICE_PORTAL_TIMEOUT(device_uid=self.device_uid))
+            return False
+
 
     def is_authorized(self):
         """Check if the session exists."""
@@ -193,92 +354,150 @@ class Device:
         """Invalidate the session token."""
         cache_conn = RedisPool.get_connection()
         cache.expire_device_access(cache_conn, self.device_uid)
+        self.access_state = None
         self.headers.pop('Authorization', None)
         self.headers.pop('X-Random', None)
         self.headers.pop('Random', None)
 
 
-    def update_authorization(self):
+    async def update_authorization(self):
         """Gets authentication for the set-top box device."""
-        awaiting_timeout = self._awaiting_timeout()
-        if awaiting_timeout:
+        if await asyncio.to_thread(self._circuit_open):
             return None
 
-        device_profile = self.get_device_profile()
+        device_profile = await asyncio.to_thread(self.get_device_profile)
         if device_profile is None:
             return None
 
-        self.update_access_token()
+        await asyncio.to_thread(self.update_access_token)
         url = f'{device_profile.portal}?type=stb&action=get_profile&hd=3&ver=ImageDescription:%202.20.04-420;%20ImageDate:%20Wed%20Aug%2019%2011:43:17%20UTC%202020;%20PORTAL%20version:%205.1.1;%20API%20Version:%20JS%20API%20version:%20348&num_banks=1&sn=092020N014162&stb_type=MAG420&image_version=220&video_out=hdmi&signature={self.signature}&auth_second_step=0&hw_version=04D-P0L-00&not_valid_token=0&JsHttpRequest=1-xml'
         if device_profile.device_id1:
             url += f"&device_id={device_profile.device_id1}"
         if device_profile.device_id2:
             url += f"&device_id2={device_profile.device_id2}"
-        response = self.session.get(url, headers=self.headers, cookies=self.cookies, timeout=15)
-        valid_response = self.__validate_response_text(response)
-        if not valid_response:
-            return None
-
-        valid_json = self.__validate_response_json(response)
-        if not valid_json:
-            return None
-
-        return json.loads(response.text).get('js', None)
-
-    @limit_recursion(max_depth=3)
-    def get(self, url):
-        """Authenticated get method for portal endpoints."""
-        awaiting_timeout = self._awaiting_timeout()
-        if awaiting_timeout:
-            return None
+        response = await self._request(url)
+        outcome, data = self.__parse_response(response)
+        return data if outcome is Outcome.SUCCESS else None
+
+    async def reauthorize(self, stale_token=None):
+        """Single-flight re-authentication. One caller across all workers performs the handshake, while the others
+        wait for it to finish and reuse the refreshed token."""
+        self._detach_from_parent()
+        async with self.auth_lock:
+            cache_conn = RedisPool.get_connection()
+            owner = uuid.uuid4().hex
+            deadline = time.monotonic() + cache.DEVICE_AUTH_LOCK_EXPIRY
+            while True:
+                if not await asyncio.to_thread(cache.get_device_auth_lock, cache_conn, self.device_uid):
+                    # Another caller may have refreshed the token while we were waiting.
+                    access_token = await asyncio.to_thread(self.update_access_token, refresh=True)
+                    if access_token is not None and access_token != stale_token:
+                        return True
+                    if await asyncio.to_thread(self._circuit_open):
+                        return False
+                    if await asyncio.to_thread(cache.acquire_device_auth_lock, cache_conn, self.device_uid, owner):
+                        break
+
+                if time.monotonic() > deadline:
+                    logging.warning(Locale.DEVICE_AUTHORIZATION_WAIT_EXPIRED(device_uid=self.device_uid))
+                    return False
+                await asyncio.sleep(0.25)
 
-        self.update_access_token()
+            try:
+                circuit_state = (await asyncio.to_thread(self.get_access_state)).circuit_state
+
+                # Attempt to refresh the access token.
+                access_token = await self.refresh_access_token()
+                if access_token is None:
+                    logging.warning(Locale.DEVICE_ACCESS_TOKEN_UNAVAILABLE(device_uid=self.device_uid))
+                    await asyncio.to_thread(self.invalidate_authorization)
+                    await asyncio.to_thread(self._record_circuit_failure, force=True)
+                    return False
+
+                is_authorized = await self.update_authorization()
+                if is_authorized is None:
+                    logging.warning(Locale.DEVICE_AUTHORIZATION_FAILED(device_uid=self.device_uid))
+                    await asyncio.to_thread(self.invalidate_authorization)
+                    await asyncio.to_thread(self._record_circuit_failure, force=True)
+                    return False
+            finally:
+                await asyncio.to_thread(cache.release_device_auth_lock, cache_conn, self.device_uid, owner)
+
+            if circuit_state is not cache.CircuitState.CLOSED:
+                await asyncio.to_thread(cache.close_device_circuit, cache_conn, self.device_uid)
+                logging.info(Locale.DEVICE_CIRCUIT_CLOSED(device_uid=self.device_uid))
+            return True
+
+
+    async def _attempt(self, url, stream_path=None, background=False):
+        """Performs a single portal request, and classifies the outcome."""
         try:
-            response = self.session.get(url, headers=self.headers, cookies=self.cookies, timeout=15)
-        except ReadTimeout:
+            response = await self._request(url, spool=stream_path is not None, background=background)
+        except asyncio.TimeoutError:
             logging.warning(Locale.GENERAL_TIMEOUT_ERROR(device_uid=self.device_uid, url=url))
-            return None
-
-        # An invalid authorization will still return a 200 status code. Check the payload and reauthenticate.
-        valid_response = self.__validate_response_text(response)
-        if not valid_response:
-            cache_conn = RedisPool.get_connection()
-            # Attempt to refresh the access token.
-            access_token = self.refresh_access_token()
-            if access_token is None:
-                logging.warning(Locale.DEVICE_ACCESS_TOKEN_UNAVAILABLE(device_uid=self.device_uid))
-                cache.set_device_timeout(cache_conn, self.device_uid)
-                self.invalidate_authorization()
-                return None
-
-            is_authorized = self.update_authorization()
-            if is_authorized is None:
-                logging.warning(Locale.DEVICE_AUTHORIZATION_FAILED(device_uid=self.device_uid))
-                cache.set_device_timeout(cache_conn, self.device_uid)
-                self.invalidate_authorization()
-                return None
-
-            # Recursively retry the get command.
-            return self.get(url)
-
-        valid_json = self.__validate_response_json(response)
-        if not valid_json:
-            return None
+            return Outcome.TIMEOUT, None
+        except aiohttp.ClientError:
+            logging.warning(Locale.GENERAL_NETWORK_ERROR(device_uid=self.device_uid, url=url))
+            return Outcome.NETWORK_ERROR, None
+
+        status_code = response.status_code
+        if status_code == HTTPStatus.TOO_MANY_REQUESTS or status_code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            if response.stream is not None:
+                response.stream.close()
+            logging.warning(Locale.DEVICE_INVALID_RESPONSE_CODE(device_uid=self.device_uid, status_code=status_code))
+            return Outcome.SERVER_ERROR, None
+
+        return self.__parse_response(response, stream_path or ('js',))
+
+
+    async def async_get(self, url, retry_policy=DEFAULT_RETRY_POLICY, stream_path=None, background=False):
+        """Authenticated get coroutine for portal endpoints, retried within the policy's attempt budget.
+        With a stream path, an iterable of the items in the array at that key path is returned instead.
+        Background requests yield the portal rate limit to interactive ones."""
+        outcome, attempt = Outcome.UNAVAILABLE, 0
+        for attempt in range(1, retry_policy.attempts + 1):
+            # Circuit and authorization state live in Redis, so they're read off the portal event loop.
+            if attempt == 1:
+                is_allowed = await asyncio.to_thread(self._circuit_allows_request)
+            else:
+                is_allowed = not await asyncio.to_thread(self._circuit_open)
+            if not is_allowed:
+                outcome = Outcome.UNAVAILABLE
+                break
+
+            access_token = await asyncio.to_thread(self.update_access_token)
+            outcome, data = await self._attempt(url, stream_path, background)
+            self.retry_stats.record_attempt(outcome, attempt)
+            if outcome is Outcome.SUCCESS:
+                await asyncio.to_thread(self._record_circuit_success)
+                return data
+            if not outcome.is_retryable() or attempt == retry_policy.attempts:
+                break
+
+            if outcome is Outcome.AUTH_FAILURE:
+                # Retry right away once the authorization has been refreshed.
+                is_authorized = await self.reauthorize(access_token)
+                if not is_authorized:
+                    outcome = Outcome.REAUTH_FAILED
+                    break
+            else:
+                await asyncio.sleep(retry_policy.get_delay(attempt))
 
-        return json.loads(response.text).get('js', None)
+        # The portal answered with something unexpected, it's still reachable.
+        if outcome is Outcome.INVALID_JSON:
+            await asyncio.to_thread(self._record_circuit_success)
+        elif outcome not in (Outcome.UNAVAILABLE, Outcome.REAUTH_FAILED):
+            await asyncio.to_thread(self._record_circuit_failure)
 
+        self.retry_stats.record_failure(outcome)
+        logging.debug(Locale.DEVICE_REQUEST_FAILED(device_uid=self.device_uid, outcome=outcome.get_name(),
+                                                   attempts=attempt))
+        return None
 
-    def get_batch(self, urls):
-        """Process a batch of URLs using the portal GET method."""
-        def get(url):
-            try:
-                get_response = self.get(url)
-                return get_response
-            except requests.exceptions.RequestException:
-                return None
 
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            response_list = list(executor.map(get, urls))
+    async def async_get_batch(self, urls, background=False):
+        """Process a batch of URLs concurrently, bounded by the per-portal concurrency limit."""
+        response_list = await asyncio.gather(*(self.async_get(url, background=background) for url in urls))
 
         # Filter out failed responses.
         filtered_responses = []
@@ -289,8 +508,34 @@ class Device:
         return filtered_responses
 
 
+    def get(self, url, stream_path=None, background=False):
+        """Authenticated get method for portal endpoints."""
+        try:
+            return PortalClient.run(self.async_get(url, stream_path=stream_path, background=background))
+        except TimeoutError:
+            logging.warning(Locale.DEVICE_PORTAL_TIMEOUT(device_uid=self.device_uid))
+            return None
+
+
+    def get_batch(self, urls, background=False):
+        """Process a batch of URLs using the portal GET method."""
+        try:
+            return PortalClient.run(self.async_get_batch(urls, background))
+        except TimeoutError:
+            logging.warning(Locale.DEVICE_PORTAL_TIMEOUT(device_uid=self.device_uid))
+            return []
+
+
     def get_channel_playlist(self, stream_id):
-        """Gets a generated channel playlist URL from channel ID."""
+        """Gets a generated channel playlist URL from channel ID, reusing recently created links."""
+        cache_conn = RedisPool.get_connection()
+        stream_link = cache.get_channel_link(cache_conn, self.device_uid, stream_id)
+        if stream_link == cache.CHANNEL_LINK_FAULT:
+            logging.warning(Locale.DEVICE_STREAM_ID_NOT_FOUND(device_uid=self.device_uid))
+            return None
+        elif stream_link is not None:
+            return stream_link
+
         device_profile = self.get_device_profile()
         if device_profile is None:
             return None
@@ -307,12 +552,21 @@ class Device:
             error = data.get('error')
             if error == 'link_fault':
                 logging.warning(Locale.DEVICE_STREAM_ID_NOT_FOUND(device_uid=self.device_uid))
+                cache.set_channel_link_fault(cache_conn, self.device_uid, stream_id)
                 return None
             else:
                 logging.warning(Locale.GENERAL_UNKNOWN_ERROR(device_uid=self.device_uid))
                 return None
 
-        return stream_link.replace('ffmpeg ', '')
+        stream_link = stream_link.replace('ffmpeg ', '')
+        cache.set_channel_link(cache_conn, self.device_uid, stream_id, stream_link)
+        return stream_link
+
+
+    def invalidate_channel_playlist(self, stream_id):
+        """Drops a cached channel playlist URL, called when the upstream rejects it."""
+        cache_conn = RedisPool.get_connection()
+        cache.expire_channel_link(cache_conn, self.device_uid, stream_id)
 
 
     def get_genres(self):
@@ -322,7 +576,7 @@ class Device:
             return None
 
         url = f'{device_profile.portal}?type=itv&action=get_genres&JsHttpRequest=1-xml'
-        genre_list = self.get(url)
+        genre_list = self.get(url, background=True)
         if genre_list is None:
             logging.warning(Locale.DEVICE_GENRE_LIST_UNAVAILABLE(device_uid=self.device_uid))
             return None
@@ -331,41 +585,159 @@ class Device:
 
 
     def get_all_channels(self):
-        """Gert a list of all the channels."""
+        """Gets all the channels, large listings are decoded one channel at a time as they're iterated."""
         device_profile = self.get_device_profile()
         if device_profile is None:
             return None
 
         url = f'{device_profile.portal}?type=itv&action=get_all_channels&JsHttpRequest=1-xml'
-        data = self.get(url)
-        if data is None:
+        channels = self.get(url, stream_path=('js', 'data'), background=True)
+        if channels is None:
             logging.warning(Locale.DEVICE_CHANNEL_LIST_UNAVAILABLE(device_uid=self.device_uid))
             return None
 
-        channels = data.get('data') if data else None
         return channels
 
 
+    def get_channel_pages(self):
+        """Gets the channel list through the paginated ordered list, yielding each page as soon as it arrives.
+        The first page gives the page count, the remaining pages are then requested a few at a time."""
+        device_profile = self.get_device_profile()
+        if device_profile is None:
+            return None
+
+        url = f'{device_profile.portal}?type=itv&action=get_ordered_list&genre=*&fav=0&sortby=number&p={{page}}&JsHttpRequest=1-xml'
+        first_page = self.get(url.format(page=1), background=True)
+        if not isinstance(first_page, dict) or not isinstance(first_page.get('data'), list):
+            logging.warning(Locale.DEVICE_CHANNEL_PAGE_UNAVAILABLE(device_uid=self.device_uid, page=1))
+            return None
+
+        try:
+            total_items = int(first_page.get('total_items') or 0)
+            page_items = int(first_page.get('max_page_items') or 0)
+        except (TypeError, ValueError):
+            total_items, page_items = 0, 0
+        page_count = -(-total_items // page_items) if page_items > 0 else 1
+        return self.__iter_channel_pages(url, first_page.get('data'), page_count)
+
+
+    def __iter_channel_pages(self, url, first_page, page_count):
+        yield first_page
+        pages = iter(range(2, page_count + 1))
+        futures = {}
+        try:
+            while True:
+                # Keep a sliding window of pages in flight, a large listing would otherwise queue every page at once.
+                for page_number in islice(pages, CHANNEL_PAGE_WINDOW - len(futures)):
+                    future = PortalClient.submit(self.async_get(url.format(page=page_number), background=True))
+                    futures[future] = page_number
+                if not futures:
+                    return
+
+                done, _ = concurrent.futures.wait(futures, timeout=PortalClient.RUN_TIMEOUT,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                if not done:
+                    raise ValueError('Channel list pages timed out.')
+                for future in done:
+                    page_number = futures.pop(future)
+                    page = future.result()
+                    if not isinstance(page, dict) or not isinstance(page.get('data'), list):
+                        logging.warning(Locale.DEVICE_CHANNEL_PAGE_UNAVAILABLE(device_uid=self.device_uid, page=page_number))
+                        raise ValueError(f'Channel list page {page_number} is unavailable.')
+                    yield page.get('data')
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+    def get_channel_batches(self):
+        """Gets the channel list in batches, using the full listing unless it has been slow or failed for this device."""
+        cache_conn = RedisPool.get_connection()
+        if cache.get_channel_list_mode(cache_conn, self.device_uid) != cache.CHANNEL_LIST_PAGED:
+            started = time.monotonic()
+            channels = self.get_all_channels()
+            if channels is not None and time.monotonic() - started <= CHANNEL_LIST_SLOW_THRESHOLD:
+                return self.__iter_channel_list(channels)
+
+            self.__use_channel_pages()
+            if channels is not None:
+                return batched(channels, CHANNEL_BATCH_SIZE)
+
+        return self.get_channel_pages()
+
+
+    def __iter_channel_list(self, channels):
+        """Batches the full listing, a listing which fails to parse switches the device to paged fetching."""
+        try:
+            yield from batched(channels, CHANNEL_BATCH_SIZE)
+        except ValueError:
+            self.__use_channel_pages()
+            raise
+
+
+    def __use_channel_pages(self):
+        logging.info(Locale.DEVICE_CHANNEL_LIST_PAGED(device_uid=self.device_uid))
+        cache.set_channel_list_mode(RedisPool.get_connection(), self.device_uid, cache.CHANNEL_LIST_PAGED)
+
+
     def encrypt_data(self, data: dict) -> str:
         """Encrypt data using device unique key."""
-        crypto = AESGCM(self.get_device_encryption_key())
-
         # 96-bit random nonce for AES-GCM
         nonce = os.urandom(12)
-        plaintext = json.dumps(data).encode()
-
-        ct = crypto.encrypt(nonce, plaintext, None)
-        blob = nonce + ct
+        payload = tokens.pack_token(data)
+        if payload is not None:
+            blob = tokens.TOKEN_VERSION + nonce + self.cipher.encrypt(nonce, payload, tokens.TOKEN_VERSION)
+        else:
+            blob = nonce + self.cipher.encrypt(nonce, json.dumps(data).encode(), None)
         return base64.urlsafe_b64encode(blob).decode().rstrip("=")  # URL safe
 
 
-    def decrypt_data(self, data: str) -> dict:
-        """Decrypt data using device unique key."""
-        crypto = AESGCM(self.get_device_encryption_key())
+    def decrypt_data(self, data: str) -> dict | None:
+        """Decrypt data using device unique key, returns None if the data is invalid."""
+        data = self.decrypt_cache(data)
+        return dict(data) if data is not None else None
 
+
+    def create_segment_handles(self, segments):
+        """Registers the segments, returning a short handle for each. Handles are keyed hashes of the upstream
+        location, so polling the same playlist again refreshes the existing handles."""
+        handle_key = self.get_device_encryption_key()
+        handles, registered = [], {}
+        for data in segments:
+            location = f"{data.get('base_link')}{data.get('path')}".encode()
+            handle = hashlib.blake2b(location, key=handle_key, digest_size=12, person=b'segment_handle').digest()
+            handle = base64.urlsafe_b64encode(handle).decode()
+            registered[handle] = orjson.dumps(data).decode()
+            handles.append(handle)
+
+        if registered:
+            cache_conn = RedisPool.get_connection()
+            cache.set_segment_handles(cache_conn, self.device_uid, registered)
+        return handles
+
+
+    def resolve_segment_handle(self, handle):
+        """Gets the segment data for a handle, returns None if it's unknown or has expired."""
+        cache_conn = RedisPool.get_connection()
+        data = cache.get_segment_handle(cache_conn, self.device_uid, handle)
+        return orjson.loads(data) if data is not None else None
+
+
+    def _decrypt_token(self, data):
         # Restore stripped padding.
         data += "=" * (-len(data) % 4)
-        raw = base64.urlsafe_b64decode(data)
-        nonce, ct = raw[:12], raw[12:]
-        plaintext = crypto.decrypt(nonce, ct, None)
-        return json.loads(plaintext)
+        try:
+            raw = base64.urlsafe_b64decode(data)
+        except (binascii.Error, ValueError):
+            return None
+
+        if raw[:1] == tokens.TOKEN_VERSION:
+            try:
+                return tokens.unpack_token(self.cipher.decrypt(raw[1:13], raw[13:], tokens.TOKEN_VERSION))
+            except (InvalidTag, ValueError):
+                pass  # The nonce of a JSON token can start with the version byte as well.
+
+        try:
+            return json.loads(self.cipher.decrypt(raw[:12], raw[12:], None))
+        except (InvalidTag, ValueError):
+            return None
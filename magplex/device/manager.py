@@ -1,15 +1,141 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from magplex import users
+from magplex.database.database import PostgresConnection
+from magplex.device import cache, tasks
 from magplex.device.device import Device
+from magplex.utilities.events import EventBus
+from magplex.utilities.localization import Locale
+from magplex.utilities.scheduler import TaskManager
+from magplex.utilities.variables import Environment
 
 
 class DeviceManager:
-    _devices = {}
+    """Bounded registry of devices, ordered from least to most recently used."""
+    _devices = OrderedDict()
+    _creation_locks = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _on_device_access_changed(cls, message):
+        if message is None:
+            for user_device in list(cls._devices.values()):
+                user_device.invalidate_access_state()
+            return
+
+        device_uid, _, version = message.partition(':')
+        user_device = cls._devices.get(device_uid)
+        if user_device is not None:
+            user_device.invalidate_access_state(version or None)
+
+    @classmethod
+    def _on_device_profile_changed(cls, message):
+        if message is None:
+            for user_device in list(cls._devices.values()):
+                user_device.invalidate_device_profile()
+            return
+
+        # The device is rebuilt from the saved profile on next use, or never if it was deleted.
+        cls.remove_user_device(message)
+
+    @classmethod
+    def _on_channel_index_changed(cls, message):
+        if message is None:
+            for user_device in list(cls._devices.values()):
+                user_device.invalidate_channel_index()
+            return
+
+        user_device = cls._devices.get(message)
+        if user_device is not None:
+            user_device.invalidate_channel_index()
+
+    @classmethod
+    def _evict(cls):
+        """Evicts idle and least recently used devices, must be called while holding the lock."""
+        evicted = []
+        now = time.monotonic()
+        while cls._devices:
+            device_uid, user_device = next(iter(cls._devices.items()))
+            is_idle = now - user_device.last_used > Environment.DEVICE_IDLE_TIMEOUT
+            if not is_idle and len(cls._devices) <= Environment.MAX_DEVICES:
+                break
+            cls._devices.pop(device_uid)
+            evicted.append(user_device)
+        return evicted
 
     @classmethod
     def get_user_device(cls, device_uid):
         device_uid = str(device_uid)
-        if device_uid in cls._devices:
-            return cls._devices.get(device_uid)
+        with cls._lock:
+            user_device = cls._devices.get(device_uid)
+            if user_device is not None:
+                cls._devices.move_to_end(device_uid)
+                user_device.last_used = time.monotonic()
+                return user_device
+            creation_lock = cls._creation_locks.setdefault(device_uid, threading.Lock())
+
+        # Only one thread builds a given device, the others wait and reuse it.
+        with creation_lock:
+            with cls._lock:
+                user_device = cls._devices.get(device_uid)
+            if user_device is not None:
+                return user_device
 
-        user_device = Device(device_uid)
-        cls._devices.update({user_device.device_uid: user_device})
+            user_device = Device(device_uid)
+            if user_device.device_profile is None:
+                user_device.close()
+                with cls._lock:
+                    cls._creation_locks.pop(device_uid, None)
+                return None
+
+            with cls._lock:
+                cls._devices[device_uid] = user_device
+                cls._creation_locks.pop(device_uid, None)
+                evicted = cls._evict()
+
+        for evicted_device in evicted:
+            logging.info(Locale.DEVICE_EVICTED(device_uid=evicted_device.device_uid))
+            evicted_device.close()
         return user_device
+
+    @classmethod
+    def remove_user_device(cls, device_uid):
+        with cls._lock:
+            user_device = cls._devices.pop(str(device_uid), None)
+        if user_device is not None:
+            user_device.close()
+
+    @classmethod
+    def remove_device_tasks(cls, device_uid):
+        """Removes the background jobs of a device which no longer exists."""
+        scheduler = TaskManager.get_scheduler()
+        for job in scheduler.get_jobs():
+            if job.id.startswith(f'{device_uid}:'):
+                scheduler.remove_job(job.id)
+
+    @classmethod
+    def schedule_tasks(cls):
+        """Adds the background tasks of every configured device to the queue, without building the devices.
+        Called by the process running the scheduler, before it starts the tasks and forks the workers."""
+        with PostgresConnection() as conn:
+            device_profiles = users.database.get_device_profiles(conn)
+        for device_profile in device_profiles:
+            tasks.schedule_tasks(device_profile.device_uid)
+
+    @classmethod
+    def prewarm(cls):
+        """Builds every configured device, so their profiles are loaded before the first request.
+        Called by each worker once forked, the devices hold a portal session bound to the process."""
+        with PostgresConnection() as conn:
+            device_profiles = users.database.get_device_profiles(conn)
+        for device_profile in device_profiles:
+            cls.get_user_device(device_profile.device_uid)
+        logging.info(Locale.DEVICE_PREWARM_COMPLETE(count=len(device_profiles)))
+
+
+EventBus.subscribe(cache.DEVICE_ACCESS_EVENT, DeviceManager._on_device_access_changed)
+EventBus.subscribe(cache.DEVICE_PROFILE_EVENT, DeviceManager._on_device_profile_changed)
+EventBus.subscribe(cache.CHANNEL_INDEX_EVENT, DeviceManager._on_channel_index_changed)
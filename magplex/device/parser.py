@@ -1,9 +1,118 @@
+import mmap
+import re
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
 import m3u8
+import orjson
 
 from magplex.device.database import Channel, ChannelGuide, Genre
+from magplex.utilities.variables import Environment
+
+
+_JSON_TOKEN = re.compile(rb'["{}\[\]:,]')
+_JSON_CONTAINER_TOKEN = re.compile(rb'["{}\[\]]')
+_JSON_SCALAR_END = re.compile(rb'[,\]}\s]')
+_JSON_WHITESPACE = b' \t\r\n'
+
+
+def _find_json_string_end(view, start):
+    """Returns the index of the closing quote for the string opened at start."""
+    index = start
+    while True:
+        index = view.find(b'"', index + 1)
+        if index == -1:
+            raise ValueError('Unterminated JSON string.')
+        escapes = 0
+        while view[index - escapes - 1] == 0x5C:
+            escapes += 1
+        if escapes % 2 == 0:
+            return index
+
+
+def _find_json_array(view, path):
+    """Walks the document structure until the array at the key path is opened, returning the index after it."""
+    keys, objects = [], []
+    key, expecting_key = None, False
+    index = 0
+    while (match := _JSON_TOKEN.search(view, index)) is not None:
+        token, index = view[match.start()], match.end()
+        if token == 0x22:
+            end = _find_json_string_end(view, match.start())
+            if expecting_key:
+                key = orjson.loads(view[match.start():end + 1])
+            index = end + 1
+        elif token in b'{[':
+            keys.append(key)
+            objects.append(token == 0x7B)
+            if token == 0x5B and tuple(keys[1:]) == path:
+                return index
+            key, expecting_key = None, token == 0x7B
+        elif token in b'}]':
+            if not keys:
+                break
+            keys.pop()
+            objects.pop()
+            key, expecting_key = None, False
+        elif token == 0x3A:
+            expecting_key = False
+        elif token == 0x2C:
+            key, expecting_key = None, bool(objects) and objects[-1]
+    return None
+
+
+def _find_json_value_end(view, start):
+    """Returns the index after the JSON value starting at start."""
+    token = view[start]
+    if token == 0x22:
+        return _find_json_string_end(view, start) + 1
+    if token not in b'{[':
+        match = _JSON_SCALAR_END.search(view, start)
+        return match.start() if match else len(view)
+
+    depth, index = 0, start
+    while (match := _JSON_CONTAINER_TOKEN.search(view, index)) is not None:
+        token, index = view[match.start()], match.end()
+        if token == 0x22:
+            index = _find_json_string_end(view, match.start()) + 1
+        elif token in b'{[':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return index
+    raise ValueError('Unterminated JSON value.')
+
+
+def _skip_json_whitespace(view, index):
+    while index < len(view) and view[index] in _JSON_WHITESPACE:
+        index += 1
+    return index
+
+
+def iter_json_array(stream, path):
+    """Incrementally decodes the items of the array found at the key path of a JSON document on disk.
+    The document is memory mapped and each item is parsed on its own, so only one item is held at a time."""
+    try:
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            index = _find_json_array(view, tuple(path))
+            if index is None:
+                raise ValueError(f'No JSON array found at {"/".join(path)}.')
+
+            while True:
+                index = _skip_json_whitespace(view, index)
+                if index >= len(view):
+                    raise ValueError('Unterminated JSON array.')
+                if view[index] == 0x5D:
+                    return
+                end = _find_json_value_end(view, index)
+                yield orjson.loads(view[index:end])
+                index = _skip_json_whitespace(view, end)
+                if index < len(view) and view[index] == 0x2C:
+                    index += 1
+    finally:
+        stream.close()
 
 
 def parse_genre(genre):
@@ -33,19 +142,22 @@ def parse_channel(channel, genres):
     if not isinstance(channel, dict):
         return None
 
-    available_genres = [g.genre_id for g in genres]
-    genre_id = channel.get('tv_genre_id')
-    if genre_id is not None and int(genre_id) not in available_genres:
-        return None
+    try:
+        available_genres = [g.genre_id for g in genres]
+        genre_id = channel.get('tv_genre_id')
+        if genre_id is not None and int(genre_id) not in available_genres:
+            return None
 
-    channel = {
-        'channel_id': int(channel.get('id')) if channel.get('id') else None,
-        'channel_number': int(channel.get('number')) if channel.get('number') else None,
-        'channel_name': channel.get('name'),
-        'channel_hd': channel.get('hd', '0') == '1',
-        'genre_id': int(channel.get('tv_genre_id')) if channel.get('tv_genre_id') else None,
-        'stream_id': channel.get('cmds', [{}])[0].get('id')
-    }
+        channel = {
+            'channel_id': int(channel.get('id')) if channel.get('id') else None,
+            'channel_number': int(channel.get('number')) if channel.get('number') else None,
+            'channel_name': channel.get('name'),
+            'channel_hd': channel.get('hd', '0') == '1',
+            'genre_id': int(channel.get('tv_genre_id')) if channel.get('tv_genre_id') else None,
+            'stream_id': channel.get('cmds', [{}])[0].get('id')
+        }
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return None
 
     for value in channel.values():
         if value is None:
@@ -122,7 +234,115 @@ def sanitize_guide_title(title: str):
     return ' '.join(title.split())
 
 
+_URI_ATTRIBUTE = re.compile(r'URI="([^"]*)"')
+_PLAYLIST_URI_TAGS = ('#EXT-X-MEDIA:', '#EXT-X-I-FRAME-STREAM-INF:', '#EXT-X-RENDITION-REPORT:')
+_URI_SCHEME = re.compile(r'[A-Za-z][A-Za-z0-9+.-]*:')
+_PROXIED_SCHEMES = ('http:', 'https:')
+
+
+@dataclass(slots=True)
+class VideoPlaylist:
+    """A rewritten playlist, which quacks like the parts of m3u8.M3U8 used by the proxy routes."""
+    content: str
+    target_duration: float | None
+    upstream_segments: list = field(default_factory=list)
+
+    def dumps(self):
+        return self.content
+
+
 def parse_video_playlist(user_device, channel_id, base_link, stream_id, session_identifier, content):
+    """Rewrites the playlist URIs to go through the proxy. Only URI lines and URI attributes are changed,
+    every other line is copied as is. Input the line rewriter doesn't understand goes through the m3u8 library."""
+    playlist = rewrite_video_playlist(user_device, channel_id, base_link, stream_id, session_identifier, content)
+    if playlist is None:
+        playlist = _parse_video_playlist_m3u8(user_device, channel_id, base_link, stream_id, session_identifier, content)
+    return playlist
+
+
+def rewrite_video_playlist(user_device, channel_id, base_link, stream_id, session_identifier, content):
+    lines = content.splitlines(keepends=True)
+    if not lines or not lines[0].startswith('#EXTM3U'):
+        return None
+
+    base_data = {
+        'stream_id': stream_id,
+        'base_link': base_link,
+        'session_identifier': session_identifier
+    }
+    proxy_link = f'/api/devices/{user_device.device_uid}/channels/{channel_id}/proxy'
+
+    def get_variant_uri(path):
+        data = base_data.copy()
+        data.update({'path': path})
+        return f"{proxy_link}/variant.m3u8?variant_data={user_device.encrypt_data(data)}"
+
+    # Lines are kept with their line endings, rewritten lines are stored as (prefix, path, suffix) until the
+    # segment and resource URIs have been created together.
+    output, segments, resources, target_duration, expecting_variant = [], [], [], None, False
+    for line in lines:
+        stripped = line.strip()
+        if not stripped:
+            output.append(line)
+            continue
+        if stripped.startswith('#'):
+            if expecting_variant and not stripped.startswith('#EXT'):
+                output.append(line)  # Plain comments may sit between a stream and its URI.
+                continue
+            if expecting_variant:
+                return None
+            if stripped.startswith('#EXT-X-STREAM-INF'):
+                expecting_variant = True
+            elif stripped.startswith('#EXT-X-TARGETDURATION:'):
+                try:
+                    target_duration = float(stripped.partition(':')[2])
+                except ValueError:
+                    return None
+            if 'URI=' in stripped:
+                uri = _URI_ATTRIBUTE.search(line)
+                if uri is None:
+                    return None
+                if not _is_proxied_uri(uri.group(1)):
+                    output.append(line)  # Other schemes, such as skd:// and data: keys, are left to the player.
+                    continue
+                if stripped.startswith(_PLAYLIST_URI_TAGS):
+                    line = f'{line[:uri.start(1)]}{get_variant_uri(uri.group(1))}{line[uri.end(1):]}'
+                else:
+                    # Keys, initialization sections and other resources are fetched like segments.
+                    resources.append(len(output))
+                    line = (line[:uri.start(1)], uri.group(1), line[uri.end(1):])
+            output.append(line)
+        elif expecting_variant:
+            prefix, path, suffix = _split_uri_line(line, stripped)
+            output.append(f'{prefix}{get_variant_uri(path)}{suffix}')
+            expecting_variant = False
+        else:
+            segments.append(len(output))
+            output.append(_split_uri_line(line, stripped))
+
+    if expecting_variant:
+        return None
+
+    upstream_segments = get_segment_data(base_data, [output[index][1] for index in segments])
+    upstream_resources = get_segment_data(base_data, [output[index][1] for index in resources])
+    uris = get_segment_uris(user_device, proxy_link, upstream_resources + upstream_segments)
+    for index, uri in zip(resources + segments, uris):
+        prefix, _, suffix = output[index]
+        output[index] = f'{prefix}{uri}{suffix}'
+    return VideoPlaylist(''.join(output), target_duration, upstream_segments)
+
+
+def _is_proxied_uri(uri):
+    scheme = _URI_SCHEME.match(uri)
+    return scheme is None or scheme.group().lower() in _PROXIED_SCHEMES
+
+
+def _split_uri_line(line, uri):
+    start = line.index(uri)
+    return line[:start], uri, line[start + len(uri):]
+
+
+def _parse_video_playlist_m3u8(user_device, channel_id, base_link, stream_id, session_identifier, content):
     content = m3u8.loads(content)
     base_data = {
         'stream_id': stream_id,
@@ -135,9 +355,29 @@ def parse_video_playlist(user_device, channel_id, base_link, stream_id, session_
         data.update({'path': variant.uri})
         variant.uri = f"/api/devices/{user_device.device_uid}/channels/{channel_id}/proxy/variant.m3u8?variant_data={user_device.encrypt_data(data)}"
 
-    for segment in content.segments:
-        data = base_data.copy()
-        data.update({'path': segment.uri})
-        segment.uri = f"/api/devices/{user_device.device_uid}/channels/{channel_id}/proxy/stream.ts?segment_data={user_device.encrypt_data(data)}"
+    proxy_link = f'/api/devices/{user_device.device_uid}/channels/{channel_id}/proxy'
+    upstream_segments = get_segment_data(base_data, [segment.uri for segment in content.segments])
+    segment_uris = get_segment_uris(user_device, proxy_link, upstream_segments)
+    for segment, segment_uri in zip(content.segments, segment_uris):
+        segment.uri = segment_uri
 
+    content.upstream_segments = upstream_segments
     return content
+
+
+def get_segment_data(base_data, paths):
+    segments = []
+    for path in paths:
+        data = base_data.copy()
+        data.update({'path': path})
+        segments.append(data)
+    return segments
+
+
+def get_segment_uris(user_device, proxy_link, segments):
+    """Gets the proxied segment URIs. With segment handles enabled the upstream location is kept server side,
+    and the URI only carries a short handle, otherwise it's encrypted into the URI."""
+    if Environment.SEGMENT_HANDLES:
+        handles = user_device.create_segment_handles(segments)
+        return [f"{proxy_link}/stream.ts?segment={handle}" for handle in handles]
+    return [f"{proxy_link}/stream.ts?segment_data={user_device.encrypt_data(data)}" for data in segments]
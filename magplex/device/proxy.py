@@ -0,0 +1,119 @@
+import time
+import uuid
+from http import HTTPStatus
+from urllib.parse import urljoin
+
+from magplex.device import cache, parser
+from magplex.device.manager import DeviceManager
+from magplex.utilities.error import ProxyError
+from magplex.utilities.localization import Locale
+from magplex.utilities.media import MediaClient
+from magplex.utilities.segments import SegmentPrefetcher
+
+
+def get_channel(device_uid, channel_id):
+    user_device = DeviceManager.get_user_device(device_uid)
+    if user_device is None or user_device.device_uid != str(device_uid):
+        raise ProxyError(Locale.DEVICE_UNAVAILABLE, HTTPStatus.FORBIDDEN)
+
+    channel = user_device.get_indexed_channel(channel_id)
+    if channel is None:
+        raise ProxyError(Locale.DEVICE_UNKNOWN_CHANNEL, HTTPStatus.NOT_FOUND)
+    return user_device, channel
+
+
+def get_master_playlist(user_device, channel):
+    stream_link = user_device.get_channel_playlist(channel.stream_id)
+    if stream_link is None:
+        raise ProxyError(Locale.DEVICE_UNKNOWN_CHANNEL, HTTPStatus.NOT_FOUND)
+    response = MediaClient.get(stream_link)
+    if response.status_code != HTTPStatus.OK:
+        # The cached link may have expired upstream, request a new one.
+        user_device.invalidate_channel_playlist(channel.stream_id)
+        stream_link = user_device.get_channel_playlist(channel.stream_id)
+        if stream_link is None:
+            raise ProxyError(Locale.DEVICE_UNKNOWN_CHANNEL, HTTPStatus.NOT_FOUND)
+        response = MediaClient.get(stream_link)
+    session_identifier = response.headers.get('X-Sid', None)
+
+    # There are often redirects, which we must follow to get the final link path.
+    base_link = urljoin(response.url, './')
+    playlist = parser.parse_video_playlist(user_device, channel.channel_id, base_link, channel.stream_id,
+                                           session_identifier, response.text)
+    return playlist.dumps()
+
+
+def get_variant_playlist(cache_conn, user_device, channel, variant_data):
+    if variant_data is None:
+        raise ProxyError(Locale.GENERAL_MISSING_ENDPOINT_PARAMETERS, HTTPStatus.BAD_REQUEST)
+
+    variant_data = user_device.decrypt_data(variant_data)
+    if variant_data is None:
+        raise ProxyError(Locale.DEVICE_INVALID_DECRYPTED_DATA, HTTPStatus.FORBIDDEN)
+
+    stream_id = variant_data.get('stream_id')
+    if stream_id != channel.stream_id:
+        raise ProxyError(Locale.DEVICE_CHANNEL_STREAM_MISMATCH, HTTPStatus.NOT_FOUND)
+
+    base_link = variant_data.get('base_link')
+    if base_link is None:
+        raise ProxyError(Locale.GENERAL_UNKNOWN_ERROR, HTTPStatus.NOT_FOUND)
+
+    session_identifier = variant_data.get('session_identifier')
+    variant_link = f"{variant_data.get('base_link')}{variant_data.get('path')}"
+    return get_shared_variant_playlist(cache_conn, user_device, channel, variant_link, base_link, session_identifier)
+
+
+def get_shared_variant_playlist(cache_conn, user_device, channel, variant_link, base_link, session_identifier):
+    """Gets the rewritten variant playlist, shared by every viewer for a fraction of its target duration.
+    A single request refreshes an expired playlist, while the others wait on its result."""
+    device_uid, channel_id = user_device.device_uid, channel.channel_id
+    owner = uuid.uuid4().hex
+    deadline = time.monotonic() + cache.VARIANT_PLAYLIST_LOCK_EXPIRY
+    while True:
+        playlist = cache.get_variant_playlist(cache_conn, device_uid, channel_id, variant_link)
+        if playlist is not None:
+            return playlist
+        if cache.acquire_variant_playlist_lock(cache_conn, device_uid, channel_id, variant_link, owner):
+            break
+        if time.monotonic() > deadline:
+            owner = None  # The refresh is taking too long, fetch it without waiting any longer.
+            break
+        time.sleep(0.05)
+
+    try:
+        headers = {"X-Sid": session_identifier} if session_identifier else {}
+        response = MediaClient.get(variant_link, headers=headers)
+        playlist = parser.parse_video_playlist(user_device, channel_id, base_link, channel.stream_id,
+                                               session_identifier, response.text)
+        content = playlist.dumps()
+        if response.status_code == HTTPStatus.OK and playlist.target_duration:
+            expiry = playlist.target_duration * cache.VARIANT_PLAYLIST_TTL_FRACTION
+            cache.set_variant_playlist(cache_conn, device_uid, channel_id, variant_link, content, expiry)
+            if SegmentPrefetcher.is_enabled():
+                SegmentPrefetcher.prefetch((device_uid, channel_id), playlist.upstream_segments,
+                                           playlist.target_duration)
+        return content
+    finally:
+        if owner is not None:
+            cache.release_variant_playlist_lock(cache_conn, device_uid, channel_id, variant_link, owner)
+
+
+def get_segment_data(user_device, channel, handle, data):
+    """Gets the upstream location of a segment, from its handle or its encrypted segment data."""
+    if not data and not handle:
+        raise ProxyError(Locale.GENERAL_MISSING_ENDPOINT_PARAMETERS, HTTPStatus.BAD_REQUEST)
+
+    if handle:
+        data = user_device.resolve_segment_handle(handle)
+        if data is None:
+            raise ProxyError(Locale.DEVICE_SEGMENT_HANDLE_EXPIRED, HTTPStatus.NOT_FOUND)
+    else:
+        data = user_device.decrypt_data(data)
+        if data is None:
+            raise ProxyError(Locale.DEVICE_INVALID_DECRYPTED_DATA, HTTPStatus.FORBIDDEN)
+
+    stream_id = data.get('stream_id')
+    if stream_id != channel.stream_id:
+        raise ProxyError(Locale.DEVICE_CHANNEL_STREAM_MISMATCH, HTTPStatus.NOT_FOUND)
+    return data
@@ -0,0 +1,56 @@
+import random
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from enum import Enum
+
+
+class Outcome(Enum):
+    SUCCESS = ('success', False)
+    AUTH_FAILURE = ('auth_failure', True)
+    TIMEOUT = ('timeout', True)
+    NETWORK_ERROR = ('network_error', True)
+    SERVER_ERROR = ('server_error', True)
+    INVALID_JSON = ('invalid_json', False)
+    REAUTH_FAILED = ('reauth_failed', False)
+    UNAVAILABLE = ('unavailable', False)
+
+    def get_name(self):
+        return self.value[0]
+
+    def is_retryable(self):
+        return self.value[1]
+
+
+@dataclass(slots=True, frozen=True)
+class RetryPolicy:
+    attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 5.0
+
+    def get_delay(self, attempt):
+        """Exponential backoff with full jitter, so retrying workers don't hit the portal in lockstep."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class RetryStats:
+    """Counters of portal request attempts, retries and their outcomes."""
+    def __init__(self):
+        self._counter = Counter()
+        self._lock = threading.Lock()
+
+    def record_attempt(self, outcome, attempt):
+        with self._lock:
+            self._counter['attempts'] += 1
+            self._counter[f'attempt_{outcome.get_name()}'] += 1
+            if attempt > 1:
+                self._counter['retries'] += 1
+
+    def record_failure(self, outcome):
+        with self._lock:
+            self._counter['failures'] += 1
+            self._counter[f'failure_{outcome.get_name()}'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counter)
@@ -1,15 +1,35 @@
 import logging
-import random
-import time
 import zoneinfo
-from datetime import datetime
+from datetime import datetime, timezone
 from itertools import batched
 
+from apscheduler.jobstores.base import ConflictingIdError
 from psycopg.errors import ForeignKeyViolation
 
-from magplex.database.database import PostgresConnection
-from magplex.device import database, parser
+from magplex.database.database import PostgresConnection, RedisPool
+from magplex.device import cache, database, parser
 from magplex.utilities.localization import Locale
+from magplex.utilities.scheduler import TaskManager
+
+
+def schedule_tasks(device_uid):
+    """Adds the background tasks of a device to the queue, unless they're already queued."""
+    scheduler = TaskManager.get_scheduler()
+    jobs = {
+        save_channels: {'hours': 1, 'args': [device_uid]},
+        save_channel_guides: {'hours': 1, 'args': [device_uid]},
+        refresh_authorization: {'minutes': 5, 'args': [device_uid]}
+    }
+
+    for job, kwargs in jobs.items():
+        job_name = f'{device_uid}:{job.__name__}'
+        try:
+            if scheduler.get_job(job_name) is not None:
+                continue
+            scheduler.add_job(job, 'interval', id=job_name, next_run_time=datetime.now(timezone.utc), **kwargs)
+            logging.info(Locale.TASK_JOB_ADDED_SUCCESSFULLY(device_uid=device_uid, job=job_name))
+        except ConflictingIdError:
+            logging.warning(Locale.TASK_CONFLICTING_JOB_IGNORED(device_uid=device_uid, job=job_name))
 
 
 def save_channels(device_uid):
@@ -17,6 +37,7 @@ def save_channels(device_uid):
     user_device = DeviceManager.get_user_device(device_uid)
     if user_device is None:
         logging.warning(Locale.DEVICE_UNAVAILABLE(device_uid=device_uid))
+        DeviceManager.remove_device_tasks(device_uid)
         return None
     logging.info(Locale.TASK_RUNNING_CHANNEL_LIST_REFRESH(device_uid=user_device.device_uid))
 
@@ -41,32 +62,45 @@ def save_channels(device_uid):
     conn.commit()
 
     genres = database.get_all_genres(conn, user_device.device_uid)
-    fetched_channels = user_device.get_all_channels()
-    if fetched_channels is None:
+    channel_batches = user_device.get_channel_batches()
+    if channel_batches is None:
         logging.warning(Locale.DEVICE_CHANNEL_LIST_UNAVAILABLE(device_uid=user_device.device_uid))
         return None
 
-    index = 0
-    while index < len(fetched_channels):
-        c = parser.parse_channel(fetched_channels[index], genres)
-        if c is None:
-            fetched_channels.pop(index)
-            continue
-        fetched_channels[index] = c
-        success = db_fk_safe(database.insert_channel, conn, user_device.device_uid,c.channel_id, c.channel_number,
-                                    c.channel_name, c.channel_hd, c.genre_id, c.stream_id)
-        if success is False:
+    # Each batch is saved as it arrives.
+    fetched_channel_ids = set()
+    channel_batches = iter(channel_batches)
+    while True:
+        try:
+            channel_batch = next(channel_batches, None)
+        except ValueError:
+            # An incomplete listing must not mark the channels it's missing as stale.
+            logging.warning(Locale.DEVICE_CHANNEL_LIST_UNAVAILABLE(device_uid=user_device.device_uid))
+            conn.rollback()
+            conn.close()
+            cache.expire_channel_index(RedisPool.get_connection(), user_device.device_uid)  # Earlier batches were saved.
             return None
-        index += 1
-    conn.commit()
+        if channel_batch is None:
+            break
+
+        for channel in channel_batch:
+            c = parser.parse_channel(channel, genres)
+            if c is None:
+                continue
+            success = db_fk_safe(database.insert_channel, conn, user_device.device_uid,c.channel_id, c.channel_number,
+                                        c.channel_name, c.channel_hd, c.genre_id, c.stream_id)
+            if success is False:
+                return None
+            fetched_channel_ids.add(c.channel_id)
+        conn.commit()
 
     # Mark missing channels as stale.
     existing_channels = database.get_channels(conn, user_device.device_uid)
-    fetched_channel_ids = [c.channel_id for c in fetched_channels]
     for existing_channel in existing_channels:
         if existing_channel.channel_id not in fetched_channel_ids:
             database.update_channel(conn, user_device.device_uid, existing_channel.channel_id, channel_stale=True)
     conn.commit()
+    cache.expire_channel_index(RedisPool.get_connection(), user_device.device_uid)
 
     # Get the latest copy of the channel list.
     channel_list = database.get_channels(conn, user_device.device_uid)
@@ -83,6 +117,7 @@ def save_channel_guides(device_uid):
     user_device = DeviceManager.get_user_device(device_uid)
     if user_device is None:
         logging.error(Locale.DEVICE_UNAVAILABLE(device_uid=device_uid))
+        DeviceManager.remove_device_tasks(device_uid)
         return None
     logging.info(Locale.TASK_RUNNING_CHANNEL_GUIDE_REFRESH(device_uid=user_device.device_uid))
 
@@ -105,9 +140,9 @@ def save_channel_guides(device_uid):
         link = f'{device_profile.portal}?type=itv&action=get_short_epg&ch_id={channel.channel_id}&JsHttpRequest=1-xml'
         guide_urls.append(link)
 
-    # Process the channel guide URLs in batches to prevent rate limiting.
-    for link_batch in batched(guide_urls, 5):
-        guide_batch = user_device.get_batch(link_batch)
+    # Process the channel guide URLs in batches, the portal rate limit lets channel tuning go ahead of them.
+    for link_batch in batched(guide_urls, 50):
+        guide_batch = user_device.get_batch(link_batch, background=True)
         conn = PostgresConnection()
         for guides in guide_batch:
             if not guides or not isinstance(guides, list):
@@ -123,7 +158,6 @@ def save_channel_guides(device_uid):
                     return None
         conn.commit()
         conn.close()
-        time.sleep(random.uniform(0, 3))
 
     conn = PostgresConnection()
     database.update_device_task_log(conn, log_uid, datetime.now(zoneinfo.ZoneInfo("Etc/UTC")))
@@ -132,6 +166,21 @@ def save_channel_guides(device_uid):
     return None
 
 
+def refresh_authorization(device_uid):
+    """Background task ran at an interval to refresh the device authorization before the access token expires."""
+    from magplex.device.manager import DeviceManager
+    user_device = DeviceManager.get_user_device(device_uid)
+    if user_device is None:
+        logging.error(Locale.DEVICE_UNAVAILABLE(device_uid=device_uid))
+        DeviceManager.remove_device_tasks(device_uid)
+        return None
+
+    is_authorized = user_device.keep_authorization_alive()
+    if not is_authorized:
+        logging.warning(Locale.DEVICE_AUTHORIZATION_FAILED(device_uid=user_device.device_uid))
+    return None
+
+
 def db_fk_safe(fn, conn, device_uid, *args, **kwargs):
     """Calls a device database function safely. Returns the function value or True on success,
      and False on foreign key violation. Ensures the device wasn't deleted while a task is running."""
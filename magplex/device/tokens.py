@@ -0,0 +1,46 @@
+import struct
+
+# Proxy URL tokens are a version byte, followed by the AES-GCM nonce and ciphertext. Tokens without the version
+# byte are the original JSON format, which is still accepted.
+TOKEN_VERSION = b'\x01'
+
+_STREAM_ID = struct.Struct('>q')
+_LENGTH = struct.Struct('>H')
+_NONE_LENGTH = 0xFFFF
+_STRING_FIELDS = ('base_link', 'path', 'session_identifier')
+
+
+def pack_token(data):
+    """Packs the token fields into a compact binary payload, or returns None if they don't fit the format."""
+    stream_id = data.get('stream_id')
+    if not isinstance(stream_id, int) or set(data) - {'stream_id', *_STRING_FIELDS}:
+        return None
+
+    payload = [_STREAM_ID.pack(stream_id)]
+    for field in _STRING_FIELDS:
+        value = data.get(field)
+        if value is None:
+            payload.append(_LENGTH.pack(_NONE_LENGTH))
+            continue
+        value = value.encode()
+        if len(value) >= _NONE_LENGTH:
+            return None
+        payload.append(_LENGTH.pack(len(value)))
+        payload.append(value)
+    return b''.join(payload)
+
+
+def unpack_token(payload):
+    data = {'stream_id': _STREAM_ID.unpack_from(payload)[0]}
+    offset = _STREAM_ID.size
+    for field in _STRING_FIELDS:
+        length = _LENGTH.unpack_from(payload, offset)[0]
+        offset += _LENGTH.size
+        if length == _NONE_LENGTH:
+            data[field] = None
+            continue
+        data[field] = payload[offset:offset + length].decode()
+        offset += length
+    if offset != len(payload):
+        raise ValueError('Unexpected trailing token data.')
+    return data
@@ -0,0 +1,43 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+
+from magplex.database.database import PostgresPool
+from magplex.device.broadcast import BroadcastHub
+from magplex.gateway.routes import routes
+from magplex.utilities.variables import Environment
+
+# Device, cache and database calls are blocking, they run on this many threads while streams stay on the event loop.
+CONTROL_THREADS = 32
+MAX_PG_CONNECTIONS = 4
+
+
+async def on_startup(app):
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(CONTROL_THREADS, thread_name_prefix='gateway'))
+    PostgresPool.set_pool_name('pool-gateway')
+    PostgresPool.set_min_size(1)
+    PostgresPool.set_max_size(MAX_PG_CONNECTIONS)
+
+    timeout = aiohttp.ClientTimeout(sock_connect=Environment.MEDIA_CONNECT_TIMEOUT,
+                                    sock_read=Environment.MEDIA_READ_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=0, ttl_dns_cache=300)
+    # Devices must not share cookies.
+    app['media_session'] = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                                 cookie_jar=aiohttp.DummyCookieJar())
+
+
+async def on_cleanup(app):
+    BroadcastHub.close_all()
+    await app['media_session'].close()
+    PostgresPool.close_pool()
+
+
+def create_gateway():
+    """Streaming gateway for the long-lived media routes, so they don't hold the threads of the app workers."""
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
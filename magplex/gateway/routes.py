@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import uuid
+from http import HTTPStatus
+
+from aiohttp import web
+
+from magplex.database.database import RedisPool
+from magplex.decorators import AuthMethod, authenticate
+from magplex.device import proxy
+from magplex.device.broadcast import BroadcastHub
+from magplex.device.manager import DeviceManager
+from magplex.stb import parser
+from magplex.utilities.error import ProxyError
+from magplex.utilities.localization import Locale
+from magplex.utilities.segments import SegmentStore
+from magplex.utilities.variables import Environment
+
+routes = web.RouteTableDef()
+
+DEVICE_ROUTE = '/api/devices/{device_uid:[0-9a-fA-F-]{32,36}}'
+CHUNK_SIZE = 64 * 1024
+PLAYLIST_HEADERS = {
+    "Content-Type": "application/vnd.apple.mpegurl",
+    "Access-Control-Allow-Origin": "*",
+    "Cache-Control": "no-cache",
+}
+SEGMENT_HEADERS = {
+    "Content-Type": "video/mp2t",
+    "Access-Control-Allow-Origin": "*",
+    "Cache-Control": "no-cache",
+}
+
+
+def error_response(message, status=HTTPStatus.BAD_REQUEST):
+    """Matches the ErrorResponse body of the app."""
+    data = {
+        "error": {
+            "name": status.name,
+            "code": status.value,
+            "message": message
+        }
+    }
+    return web.json_response(data, status=status.value)
+
+
+def get_route_args(request):
+    try:
+        return uuid.UUID(request.match_info['device_uid']), int(request.match_info['channel_id'])
+    except ValueError:
+        raise web.HTTPNotFound()
+
+
+@routes.get(DEVICE_ROUTE + '/channels/{channel_id:\\d+}/master.m3u8')
+async def proxy_playlist(request):
+    device_uid, channel_id = get_route_args(request)
+    authentication = await asyncio.to_thread(authenticate, AuthMethod.ALL, request.headers.get('X-Api-Key'),
+                                             request.cookies.get('session_uid'))
+    if authentication is None:
+        return error_response(Locale.GENERAL_INVALID_CREDENTIALS, HTTPStatus.FORBIDDEN)
+
+    def get_playlist():
+        user_device, channel = proxy.get_channel(device_uid, channel_id)
+        return proxy.get_master_playlist(user_device, channel)
+
+    try:
+        playlist = await asyncio.to_thread(get_playlist)
+    except ProxyError as e:
+        return error_response(e.message, e.status)
+    return web.Response(body=playlist.encode(), headers=PLAYLIST_HEADERS)
+
+
+@routes.get(DEVICE_ROUTE + '/channels/{channel_id:\\d+}/proxy/variant.m3u8')
+async def proxy_variant(request):
+    device_uid, channel_id = get_route_args(request)
+
+    def get_playlist():
+        user_device, channel = proxy.get_channel(device_uid, channel_id)
+        return proxy.get_variant_playlist(RedisPool.get_connection(), user_device, channel,
+                                          request.query.get('variant_data'))
+
+    try:
+        playlist = await asyncio.to_thread(get_playlist)
+    except ProxyError as e:
+        return error_response(e.message, e.status)
+    return web.Response(body=playlist.encode(), headers=PLAYLIST_HEADERS)
+
+
+@routes.get(DEVICE_ROUTE + '/channels/{channel_id:\\d+}/proxy/stream.ts')
+async def proxy_stream(request):
+    device_uid, channel_id = get_route_args(request)
+
+    def get_segment_data():
+        user_device, channel = proxy.get_channel(device_uid, channel_id)
+        return proxy.get_segment_data(user_device, channel, request.query.get('segment'),
+                                      request.query.get('segment_data'))
+
+    try:
+        data = await asyncio.to_thread(get_segment_data)
+    except ProxyError as e:
+        return error_response(e.message, e.status)
+
+    session_identifier = data.get('session_identifier')
+    headers = {"X-Sid": session_identifier} if session_identifier else {}
+    stream_link = f"{data.get('base_link')}{data.get('path')}"
+
+    # Serve the segment from the shared cache, or attach to another request already fetching it. The cache is in
+    # shared memory, chunks are read and written on the event loop, while opening and evicting segments runs in
+    # a thread.
+    claim = None
+    if SegmentStore.is_enabled():
+        segment_key = SegmentStore.get_key(data.get('base_link'), data.get('path'))
+        if await asyncio.to_thread(SegmentStore.touch, segment_key):
+            if Environment.SEGMENT_ACCEL_REDIRECT:
+                # The internal location nginx sends the file from sets the response headers.
+                return web.Response(content_type="video/mp2t",
+                                    headers={"X-Accel-Redirect": SegmentStore.get_accel_redirect(segment_key)})
+            return web.FileResponse(SegmentStore.get_path(segment_key), headers=SEGMENT_HEADERS)
+
+        claim = await asyncio.to_thread(SegmentStore.claim, segment_key)
+        if claim is None:
+            segment_chunks = SegmentStore.attach_async(segment_key)
+            if segment_chunks is not None:
+                return await stream_segment_chunks(request, segment_chunks)
+            if await asyncio.to_thread(SegmentStore.touch, segment_key):
+                return web.FileResponse(SegmentStore.get_path(segment_key), headers=SEGMENT_HEADERS)
+
+    session = request.app['media_session']
+    try:
+        upstream = await session.get(stream_link, headers=headers)
+    except Exception:
+        if claim is not None:
+            await asyncio.to_thread(SegmentStore.release, claim)
+        return error_response(Locale.DEVICE_STREAM_SEGMENT_FAILED, HTTPStatus.BAD_GATEWAY)
+
+    async with upstream:
+        if upstream.status != HTTPStatus.OK:
+            if claim is not None:
+                await asyncio.to_thread(SegmentStore.release, claim)
+            return error_response(Locale.DEVICE_STREAM_SEGMENT_FAILED, HTTPStatus(upstream.status))
+
+        response = web.StreamResponse(headers=SEGMENT_HEADERS)
+        await response.prepare(request)
+        complete, connected = False, True
+        try:
+            async for chunk in upstream.content.iter_chunked(CHUNK_SIZE):
+                if claim is not None:
+                    SegmentStore.write(claim, chunk)
+                if connected:
+                    try:
+                        await response.write(chunk)
+                    except ConnectionResetError:
+                        # Keep filling the segment for any requests attached to it.
+                        connected = False
+                if not connected and (claim is None or claim.file is None):
+                    break
+            complete = True
+        except Exception:
+            pass
+        finally:
+            if claim is not None:
+                if complete and claim.file is not None:
+                    await asyncio.to_thread(SegmentStore.commit, claim)
+                else:
+                    await asyncio.to_thread(SegmentStore.release, claim)
+    return response
+
+
+async def stream_segment_chunks(request, segment_chunks):
+    """Streams a segment being written by another request, following the file from the event loop as it grows."""
+    response = web.StreamResponse(headers=SEGMENT_HEADERS)
+    await response.prepare(request)
+    try:
+        async for chunk in segment_chunks:
+            await response.write(chunk)
+    except ConnectionResetError:
+        pass
+    finally:
+        await segment_chunks.aclose()
+    return response
+
+
+@routes.get(DEVICE_ROUTE + '/stb/{channel_id:\\d+}/stream.ts')
+async def get_stb_channel_playlist(request):
+    device_uid, channel_id = get_route_args(request)
+    user_device = await asyncio.to_thread(DeviceManager.get_user_device, device_uid)
+    if user_device is None:
+        return error_response(Locale.DEVICE_UNAVAILABLE, HTTPStatus.FORBIDDEN)
+
+    channel = await asyncio.to_thread(user_device.get_indexed_channel, channel_id)
+    if channel is None:
+        return error_response(Locale.DEVICE_CHANNEL_PLAYLIST_UNAVAILABLE, HTTPStatus.NOT_FOUND)
+
+    if Environment.BASE_FFMPEG is None:
+        logging.error("Unable to find ffmpeg installation.")
+        return web.Response(status=HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    hub_stream = await asyncio.to_thread(BroadcastHub.open_stream, user_device, channel, asyncio.get_running_loop())
+    if hub_stream is None:
+        response = error_response(Locale.TUNER_UNAVAILABLE, HTTPStatus.SERVICE_UNAVAILABLE)
+        response.headers["X-HDHomeRun-Error"] = parser.TUNERS_BUSY_ERROR
+        return response
+
+    response = web.StreamResponse(headers={"Content-Type": "video/mp2t", "Access-Control-Allow-Origin": "*"})
+    try:
+        await response.prepare(request)
+        async for chunk in hub_stream:
+            await response.write(chunk)
+    except ConnectionResetError:
+        pass
+    finally:
+        hub_stream.close()
+    return response
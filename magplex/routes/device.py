@@ -1,20 +1,20 @@
 import logging
-import time
 from collections import defaultdict
 from datetime import datetime, timezone
 from http import HTTPStatus
-from urllib.parse import urljoin
 
-import requests
-from flask import Blueprint, Response, g, jsonify, redirect, request, stream_with_context
+from flask import Blueprint, Response, g, jsonify, redirect, request, send_file, stream_with_context
 
 from magplex.decorators import AuthMethod, authorize_route
-from magplex.device import database, parser
+from magplex.device import cache, database, proxy
 from magplex.device.manager import DeviceManager
 from magplex.utilities import sanitizer
-from magplex.utilities.error import ErrorResponse
+from magplex.utilities.error import ErrorResponse, ProxyError
 from magplex.utilities.localization import Locale
+from magplex.utilities.media import MediaClient
 from magplex.utilities.scheduler import TaskManager
+from magplex.utilities.segments import SegmentStore
+from magplex.utilities.variables import Environment
 
 device = Blueprint("device", __name__)
 
@@ -67,6 +67,8 @@ def update_channels(device_uid):
     if 'channel_enabled' in data:
         kwargs.update({'channel_enabled': sanitizer.sanitize_bool(data.get('channel_enabled'))})
     database.update_channels(g.db_conn, user_device.device_uid, **kwargs)
+    g.db_conn.commit()
+    cache.expire_channel_index(g.cache_conn, user_device.device_uid)
     return Response(status=HTTPStatus.OK)
 
 
@@ -93,7 +95,7 @@ def get_channel_playlist(device_uid, channel_id):
     if user_device is None or user_device.device_uid != str(device_uid):
         return ErrorResponse(Locale.DEVICE_UNAVAILABLE, HTTPStatus.FORBIDDEN)
 
-    channel = database.get_channel(g.db_conn, user_device.device_uid, channel_id)
+    channel = user_device.get_indexed_channel(channel_id)
     if channel is None:
         return ErrorResponse(Locale.DEVICE_UNKNOWN_CHANNEL, HTTPStatus.NOT_FOUND)
 
@@ -120,6 +122,8 @@ def update_channel(device_uid, channel_id):
     if 'channel_enabled' in data:
         kwargs.update({'channel_enabled': sanitizer.sanitize_bool(data.get('channel_enabled'))})
     database.update_channel(g.db_conn, user_device.device_uid, channel_id, **kwargs)
+    g.db_conn.commit()
+    cache.expire_channel_index(g.cache_conn, user_device.device_uid)
 
     return Response(status=HTTPStatus.OK)
 
@@ -155,41 +159,44 @@ def sync_channel_guides(device_uid):
     return Response(status=HTTPStatus.ACCEPTED)
 
 
-@device.get('/<uuid:device_uid>/channels/<int:channel_id>/guide')
+@device.get('/<uuid:device_uid>/circuit')
 @authorize_route(auth_method=AuthMethod.ALL)
-def get_channel_guide(device_uid, channel_id):
+def get_circuit(device_uid):
     user_device = DeviceManager.get_user_device(device_uid)
     if user_device is None or user_device.device_uid != str(device_uid):
         return ErrorResponse(Locale.DEVICE_UNAVAILABLE, HTTPStatus.FORBIDDEN)
 
-    channel_guide = database.get_channel_guide(g.db_conn, user_device.device_uid, channel_id)
-    return jsonify(channel_guide)
+    access_state = user_device.get_access_state(refresh=True)
+    return jsonify({
+        'state': access_state.circuit_state,
+        'trips': access_state.circuit_trips,
+        'retry_in': round(access_state.circuit_retry_in, 3),
+        'retry_stats': user_device.retry_stats.snapshot()
+    })
 
 
-@device.get('/<uuid:device_uid>/channels/<int:channel_id>/master.m3u8')
+@device.get('/<uuid:device_uid>/channels/<int:channel_id>/guide')
 @authorize_route(auth_method=AuthMethod.ALL)
-def proxy_playlist(device_uid, channel_id):
+def get_channel_guide(device_uid, channel_id):
     user_device = DeviceManager.get_user_device(device_uid)
     if user_device is None or user_device.device_uid != str(device_uid):
         return ErrorResponse(Locale.DEVICE_UNAVAILABLE, HTTPStatus.FORBIDDEN)
 
-    channel = database.get_channel(g.db_conn, user_device.device_uid, channel_id)
-    if channel is None:
-        return ErrorResponse(Locale.DEVICE_UNKNOWN_CHANNEL, HTTPStatus.NOT_FOUND)
+    channel_guide = database.get_channel_guide(g.db_conn, user_device.device_uid, channel_id)
+    return jsonify(channel_guide)
 
-    stream_link = user_device.get_channel_playlist(channel.stream_id)
-    if stream_link is None:
-        return ErrorResponse(Locale.DEVICE_UNKNOWN_CHANNEL, status=HTTPStatus.NOT_FOUND)
-    response = requests.get(stream_link)
-    session_identifier = response.headers.get('X-Sid', None)
 
-    # There are often redirects, which we must follow to get the final link path.
-    base_link = urljoin(response.url, './')
-    playlist = parser.parse_video_playlist(user_device, channel_id, base_link, channel.stream_id,
-                                           session_identifier, response.text)
+@device.get('/<uuid:device_uid>/channels/<int:channel_id>/master.m3u8')
+@authorize_route(auth_method=AuthMethod.ALL)
+def proxy_playlist(device_uid, channel_id):
+    try:
+        user_device, channel = proxy.get_channel(device_uid, channel_id)
+        playlist = proxy.get_master_playlist(user_device, channel)
+    except ProxyError as e:
+        return ErrorResponse(e.message, e.status)
 
     return Response(
-        playlist.dumps(),
+        playlist,
         headers={
             "Content-Type": "application/vnd.apple.mpegurl",
             "Access-Control-Allow-Origin": "*",
@@ -200,38 +207,14 @@ def proxy_playlist(device_uid, channel_id):
 
 @device.get('/<uuid:device_uid>/channels/<int:channel_id>/proxy/variant.m3u8')
 def proxy_variant(device_uid, channel_id):
-    user_device = DeviceManager.get_user_device(device_uid)
-    if user_device is None or user_device.device_uid != str(device_uid):
-        return ErrorResponse(Locale.DEVICE_UNAVAILABLE, HTTPStatus.FORBIDDEN)
-
-    channel = database.get_channel(g.db_conn, user_device.device_uid, channel_id)
-    if channel is None:
-        return ErrorResponse(Locale.DEVICE_UNKNOWN_CHANNEL, HTTPStatus.NOT_FOUND)
-
-    variant_data = request.args.get('variant_data')
-    if variant_data is None:
-        return ErrorResponse(Locale.GENERAL_MISSING_ENDPOINT_PARAMETERS, HTTPStatus.BAD_REQUEST)
-
-    variant_data = user_device.decrypt_data(variant_data)
-    stream_id = variant_data.get('stream_id')
-    if stream_id != channel.stream_id:
-        return ErrorResponse(Locale.DEVICE_CHANNEL_STREAM_MISMATCH, status=HTTPStatus.NOT_FOUND)
-
-    base_link = variant_data.get('base_link')
-    if base_link is None:
-        return ErrorResponse(Locale.GENERAL_UNKNOWN_ERROR, status=HTTPStatus.NOT_FOUND)
-
-    session_identifier = variant_data.get('session_identifier')
-    headers = {"X-Sid": session_identifier} if session_identifier else {}
-
-    variant_link = f"{variant_data.get('base_link')}{variant_data.get('path')}"
-    response = requests.get(variant_link, headers=headers)
-
-    playlist = parser.parse_video_playlist(user_device, channel_id, base_link, channel.stream_id,
-                                           session_identifier, response.text)
+    try:
+        user_device, channel = proxy.get_channel(device_uid, channel_id)
+        playlist = proxy.get_variant_playlist(g.cache_conn, user_device, channel, request.args.get('variant_data'))
+    except ProxyError as e:
+        return ErrorResponse(e.message, e.status)
 
     return Response(
-        playlist.dumps(),
+        playlist,
         headers={
             "Content-Type": "application/vnd.apple.mpegurl",
             "Access-Control-Allow-Origin": "*",
@@ -242,38 +225,64 @@ def proxy_variant(device_uid, channel_id):
 
 @device.get('/<uuid:device_uid>/channels/<int:channel_id>/proxy/stream.ts')
 def proxy_stream(device_uid, channel_id):
-    user_device = DeviceManager.get_user_device(device_uid)
-    if user_device is None:
-        return ErrorResponse(Locale.DEVICE_UNAVAILABLE, status=HTTPStatus.FORBIDDEN)
-
-    data = request.args.get("segment_data")
-    if not data:
-        return ErrorResponse(Locale.GENERAL_MISSING_ENDPOINT_PARAMETERS, HTTPStatus.BAD_REQUEST)
-
-    channel = database.get_channel(g.db_conn, user_device.device_uid, channel_id)
-    if channel is None:
-        return ErrorResponse(Locale.DEVICE_UNKNOWN_CHANNEL, HTTPStatus.NOT_FOUND)
-
-    data = user_device.decrypt_data(data)
-    if data is None:
-        return ErrorResponse(Locale.DEVICE_INVALID_DECRYPTED_DATA, status=HTTPStatus.FORBIDDEN)
-
-    stream_id = data.get('stream_id')
-    if stream_id != channel.stream_id:
-        return ErrorResponse(Locale.DEVICE_CHANNEL_STREAM_MISMATCH, status=HTTPStatus.NOT_FOUND)
+    try:
+        user_device, channel = proxy.get_channel(device_uid, channel_id)
+        data = proxy.get_segment_data(user_device, channel, request.args.get("segment"), request.args.get("segment_data"))
+    except ProxyError as e:
+        return ErrorResponse(e.message, e.status)
 
     session_identifier = data.get('session_identifier')
     headers = {"X-Sid": session_identifier} if session_identifier else {}
 
     stream_link = f"{data.get('base_link')}{data.get('path')}"
-    r = requests.get(stream_link, headers=headers, stream=True, allow_redirects=True)
+
+    # Serve the segment from the shared cache, or attach to another request already fetching it.
+    claim = None
+    if SegmentStore.is_enabled():
+        segment_key = SegmentStore.get_key(data.get('base_link'), data.get('path'))
+        if Environment.SEGMENT_ACCEL_REDIRECT and SegmentStore.touch(segment_key):
+            # nginx sends the file itself, from the internal location aliasing the segment cache, which also sets
+            # the response headers.
+            response = Response(status=HTTPStatus.OK, content_type="video/mp2t")
+            response.headers["X-Accel-Redirect"] = SegmentStore.get_accel_redirect(segment_key)
+            return response
+
+        segment_file = SegmentStore.open(segment_key)
+        if segment_file is not None:
+            response = send_file(segment_file, mimetype="video/mp2t", conditional=False)
+            return segment_response(response)
+
+        claim = SegmentStore.claim(segment_key)
+        if claim is None:
+            segment_chunks = SegmentStore.attach(segment_key)
+            if segment_chunks is not None:
+                response = Response(stream_with_context(segment_chunks), status=HTTPStatus.OK,
+                                    direct_passthrough=True, content_type="video/mp2t")
+                return segment_response(response)
+
+    r = MediaClient.get(stream_link, headers=headers, stream=True)
 
     if r.status_code != HTTPStatus.OK:
+        r.close()
+        if claim is not None:
+            SegmentStore.release(claim)
         return ErrorResponse(Locale.DEVICE_STREAM_SEGMENT_FAILED, HTTPStatus(r.status_code))
 
-    response = Response(stream_with_context(r.iter_content(chunk_size=8192)), status=HTTPStatus.OK,
+    def generate():
+        try:
+            chunks = r.iter_content(chunk_size=8192)
+            if claim is not None:
+                chunks = SegmentStore.fill(claim, chunks)
+            yield from chunks
+        finally:
+            r.close()  # Return the connection to the pool, even when the client disconnects early.
+
+    response = Response(stream_with_context(generate()), status=HTTPStatus.OK,
                         direct_passthrough=True, content_type="video/mp2t")
+    return segment_response(response)
+
 
+def segment_response(response):
     response.headers["Cache-Control"] = "no-cache"
     response.headers["Access-Control-Allow-Origin"] = "*"
     return response
@@ -1,12 +1,11 @@
 import logging
-import threading
 from http import HTTPStatus
 
-import requests
 from flask import Blueprint, Response, g, jsonify, request, stream_with_context
 
 from magplex.decorators import AuthMethod, authorize_route
-from magplex.device import database, media
+from magplex.device import cache, database
+from magplex.device.broadcast import BroadcastHub
 from magplex.device.manager import DeviceManager
 from magplex.stb import parser
 from magplex.utilities.error import ErrorResponse
@@ -33,7 +32,7 @@ def get_stb_discover(device_uid):
     if user_device is None:
         return ErrorResponse(Locale.DEVICE_UNAVAILABLE, status=HTTPStatus.FORBIDDEN)
     domain = request.host_url[:-1]
-    return jsonify(parser.build_discover(domain))
+    return jsonify(parser.build_discover(domain, Environment.TUNER_COUNT))
 
 
 @stb.get('/<uuid:device_uid>/stb/lineup_status.json')
@@ -42,7 +41,8 @@ def get_stb_lineup_status(device_uid):
     user_device = DeviceManager.get_user_device(device_uid)
     if user_device is None:
         return ErrorResponse(Locale.DEVICE_UNAVAILABLE, status=HTTPStatus.FORBIDDEN)
-    return jsonify(parser.build_status())
+    tuners = cache.get_tuners(g.cache_conn, user_device.device_uid)
+    return jsonify(parser.build_status(Environment.TUNER_COUNT, tuners))
 
 
 @stb.get('/<uuid:device_uid>/stb/lineup.json')
@@ -62,7 +62,7 @@ def get_stb_channel_playlist(device_uid, channel_id):
     if user_device is None:
         return ErrorResponse(Locale.DEVICE_UNAVAILABLE, status=HTTPStatus.FORBIDDEN)
 
-    channel = database.get_channel(g.db_conn, device_uid, channel_id)
+    channel = user_device.get_indexed_channel(channel_id)
     if channel is None:
         return ErrorResponse(Locale.DEVICE_CHANNEL_PLAYLIST_UNAVAILABLE, status=HTTPStatus.NOT_FOUND)
 
@@ -70,34 +70,14 @@ def get_stb_channel_playlist(device_uid, channel_id):
         logging.error("Unable to find ffmpeg installation.")
         return Response(status=HTTPStatus.INTERNAL_SERVER_ERROR)
 
-    encoder = media.get_encoder()
-    def stream_generator():
-        process = None
-        try:
-            while True:
-                channel_url = user_device.get_channel_playlist(channel.stream_id)
-                logging.error(channel_url)
-                if not channel_url:
-                    break
-                r = requests.get(channel_url, allow_redirects=True)
-                headers = ''.join(f"{k}: {v}\r\n" for k, v in r.headers.items() if k in ['X-Sid', 'User-Agent', 'Referer', 'Origin'])
-                process = media.create_stream_response(channel_url, encoder, headers)
-                for chunk in iter(lambda: process.stdout.read(64 * 1024), b''):
-                    yield chunk
-        finally:
-            if process:
-                try:
-                    process.terminate()
-                except Exception:
-                    pass
-                threading.Thread(target=lambda p: (p.wait() or p.kill()), args=(process,), daemon=True).start()
-                try:
-                    process.stdout.close()
-                except Exception:
-                    pass
+    hub_stream = BroadcastHub.open_stream(user_device, channel)
+    if hub_stream is None:
+        response = ErrorResponse(Locale.TUNER_UNAVAILABLE, status=HTTPStatus.SERVICE_UNAVAILABLE)
+        response.headers["X-HDHomeRun-Error"] = parser.TUNERS_BUSY_ERROR
+        return response
 
     return Response(
-        stream_with_context(stream_generator()),
+        stream_with_context(hub_stream),
         direct_passthrough=True,
         headers={
             "Content-Type": "video/mp2t",
@@ -6,10 +6,12 @@ from flask import Blueprint, Response, g, jsonify, make_response, render_templat
 
 import version
 from magplex import RedisPool
+from magplex.database.database import PostgresPool
 from magplex.decorators import AuthMethod, authorize_route
 from magplex.device import database
 from magplex.utilities.error import ErrorResponse
 from magplex.utilities.logs import REDIS_BUFFER_CHANNEL, REDIS_LOG_BUFFER
+from magplex.utilities.media import MediaClient
 
 ui = Blueprint("ui", __name__)
 
@@ -70,6 +72,15 @@ def get_about():
     })
 
 
+@ui.route('/stats')
+@authorize_route(auth_method=AuthMethod.SESSION)
+def get_stats():
+    return jsonify({
+        'media': MediaClient.get_stats(),
+        'postgres': PostgresPool.get_stats()
+    })
+
+
 @ui.get("/stalker")
 def portal_root():
     return make_response(render_template('portal.html'), 200, {
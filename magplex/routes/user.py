@@ -4,6 +4,7 @@ from http import HTTPStatus
 from flask import Blueprint, Response, g, jsonify, redirect, request
 
 from magplex.decorators import AuthMethod, authorize_route
+from magplex.device import cache
 from magplex.device.validators import validate_portal_loader, validate_portal_referer
 from magplex.users import database
 from magplex.utilities import sanitizer
@@ -134,13 +135,21 @@ def save_user_device():
 
     database.insert_user_device(g.db_conn, g.user_session.user_uid, mac_address, device_id1, device_id2, timezone,
                                 portal, referer)
+    device_profile = database.get_device_profile_by_user(g.db_conn, g.user_session.user_uid)
+    g.db_conn.commit()  # Commit before other workers are told to reload the profile.
+    if device_profile is not None:
+        cache.expire_device_profile(g.cache_conn, device_profile.device_uid)
     return Response(status=HTTPStatus.NO_CONTENT)
 
 
 @user.delete('/device')
 @authorize_route(auth_method=AuthMethod.SESSION)
 def delete_user_device():
+    device_profile = database.get_device_profile_by_user(g.db_conn, g.user_session.user_uid)
     database.delete_user_device(g.db_conn, g.user_session.user_uid)
+    g.db_conn.commit()  # Commit before other workers are told to reload the profile.
+    if device_profile is not None:
+        cache.expire_device_profile(g.cache_conn, device_profile.device_uid)
     return Response(status=HTTPStatus.NO_CONTENT)
 
 
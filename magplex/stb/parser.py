@@ -75,7 +75,10 @@ def build_device_info(device_uid, domain):
     return xml
 
 
-def build_discover(domain):
+TUNERS_BUSY_ERROR = '805 All Tuners In Use'  # X-HDHomeRun-Error of a stream request when no tuner is free.
+
+
+def build_discover(domain, tuner_count):
     return {
         "BaseURL": domain,
         "DeviceAuth": "Magplex",
@@ -86,15 +89,21 @@ def build_discover(domain):
         "LineupURL": f"{domain}/lineup.json",
         "Manufacturer": "LegendaryFire",
         "ModelNumber": "1.2",
-        "TunerCount": 1
+        "TunerCount": tuner_count
     }
 
-def build_status():
+def build_status(tuner_count, tuners):
     return {
         "ScanInProgress": 0,
         "ScanPossible": 1,
         "Source": "Cable",
-        "Lineup": "Complete"
+        "Lineup": "Complete",
+        "TunerCount": tuner_count,
+        "TunersInUse": len(tuners),
+        "Tuners": [
+            {"Resource": f"tuner{index}", "VctNumber": f"{channel_id}", "Idle": int(idle)}
+            for index, (channel_id, idle) in enumerate(tuners)
+        ]
     }
 
 
@@ -191,6 +191,17 @@ def get_device_profile_by_uid(conn, device_uid):
         return DeviceProfile(*row) if row else None
 
 
+def get_device_profiles(conn):
+    with conn.cursor() as cursor:
+        query = """
+            select device_uid, user_uid, mac_address, device_id1, device_id2, timezone, portal, referer,
+                   modified_timestamp, creation_timestamp
+            from devices
+        """
+        cursor.execute(query)
+        return [DeviceProfile(*row) for row in cursor]
+
+
 def get_device_profile_by_user(conn, user_uid):
     with conn.cursor() as cursor:
         query = """
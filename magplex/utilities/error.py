@@ -7,6 +7,14 @@ class InvalidJsonError(Exception):
     pass
 
 
+class ProxyError(Exception):
+    """A stream proxy request which can't be served, raised by logic shared between the app and the gateway."""
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
 class ErrorResponse(Response):
     def __init__(self, message, status=HTTPStatus.BAD_REQUEST):
         self.message = message
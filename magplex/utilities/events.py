@@ -0,0 +1,90 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+import redis
+
+from magplex.database.database import RedisPool
+
+EVENT_CHANNEL_PREFIX = 'magplex:events:'
+
+
+def get_event_channel(event):
+    return f'{EVENT_CHANNEL_PREFIX}{event}'
+
+
+class EventBus:
+    """Process-wide Redis pub/sub listener, used to invalidate in-process caches across workers.
+    Handlers receive the published message, or None when messages may have been missed and everything is stale."""
+    _handlers = defaultdict(list)
+    _thread = None
+    _pid = None
+    _listening = False
+    _lock = threading.Lock()
+
+    @classmethod
+    def subscribe(cls, event, handler):
+        with cls._lock:
+            cls._handlers[event].append(handler)
+        cls.start()
+
+    @classmethod
+    def publish(cls, conn, event, message):
+        conn.publish(get_event_channel(event), message)
+
+    @classmethod
+    def start(cls):
+        """Lazily start the listener thread, recreating it after a fork."""
+        if cls._pid == os.getpid():
+            return
+        with cls._lock:
+            if cls._pid == os.getpid():
+                return
+            cls._pid = os.getpid()
+            cls._listening = False
+            cls._thread = threading.Thread(target=cls._listen, name='event-bus', daemon=True)
+            cls._thread.start()
+
+    @classmethod
+    def is_listening(cls):
+        """In-process caches should only be trusted while invalidation messages are being received."""
+        cls.start()
+        return cls._listening
+
+    @classmethod
+    def _dispatch(cls, event, message):
+        for handler in list(cls._handlers.get(event, [])):
+            try:
+                handler(message)
+            except Exception:
+                logging.exception(f'Event handler failed for {event}.')
+
+    @classmethod
+    def _listen(cls):
+        pid = os.getpid()
+        while cls._pid == pid:
+            pubsub = None
+            try:
+                pubsub = RedisPool.get_connection().pubsub()
+                pubsub.psubscribe(f'{EVENT_CHANNEL_PREFIX}*')
+                while cls._pid == pid:
+                    msg = pubsub.get_message(timeout=1.0)
+                    if msg and msg['type'] == 'psubscribe':
+                        cls._listening = True
+                    elif msg and msg['type'] == 'pmessage':
+                        cls._dispatch(msg['channel'].removeprefix(EVENT_CHANNEL_PREFIX), msg['data'])
+            except redis.exceptions.RedisError:
+                pass
+            finally:
+                # Any message published while disconnected is lost, so every cache must be dropped.
+                cls._listening = False
+                for event in list(cls._handlers):
+                    cls._dispatch(event, None)
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except redis.exceptions.RedisError:
+                        pass
+            time.sleep(1)
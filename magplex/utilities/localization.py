@@ -9,22 +9,41 @@ class Locale(StrEnum):
     GENERAL_MISSING_REQUIRED_FIELDS = 'Missing or invalid required fields, please try again'
     GENERAL_UNKNOWN_ERROR = 'An unknown error has occurred'
     GENERAL_TIMEOUT_ERROR = 'Network request timed out'
+    GENERAL_NETWORK_ERROR = 'Network request failed'
+
+    # Broadcast Localization
+    BROADCAST_CLIENT_DROPPED = 'Client kept falling behind the channel broadcast, disconnecting it'
+    BROADCAST_CLIENT_LAGGED = 'Client fell behind the channel broadcast, skipping ahead to live'
+    BROADCAST_HUB_CLOSED = 'Channel broadcast has stopped'
+    BROADCAST_HUB_FAILED = 'Channel broadcast failed unexpectedly'
+    BROADCAST_HUB_STARTED = 'Channel broadcast has started'
 
     # Device Localization
     DEVICE_ACCESS_TOKEN_UNAVAILABLE = 'Unable to retrieve device access token'
     DEVICE_AUTHORIZATION_FAILED = 'Device authorization check failed'
-    DEVICE_AWAITING_TIMEOUT = 'Awaiting device timeout, request has been skipped'
+    DEVICE_AUTHORIZATION_WAIT_EXPIRED = 'Gave up waiting on device authorization from another worker'
     DEVICE_CHANNEL_LIST_SUCCESSFUL = 'Device channels have been successfully saved'
+    DEVICE_CHANNEL_LIST_PAGED = 'Channel list is slow or unavailable, switching to paged fetching'
     DEVICE_CHANNEL_LIST_UNAVAILABLE = 'Unable to retrieve channel list'
+    DEVICE_CHANNEL_PAGE_UNAVAILABLE = 'Unable to retrieve channel list page'
     DEVICE_CHANNEL_PLAYLIST_UNAVAILABLE = 'Unable to retrieve channel playlist'
     DEVICE_CHANNEL_STREAM_MISMATCH = 'Stream ID did not match the one provided'
+    DEVICE_CIRCUIT_CLOSED = 'Portal has recovered, device circuit closed'
+    DEVICE_CIRCUIT_OPEN = 'Device circuit is open, request has been skipped'
+    DEVICE_CIRCUIT_TRIPPED = 'Portal is failing, device circuit opened'
+    DEVICE_EVICTED = 'Device has been evicted from the device registry'
     DEVICE_GENRE_LIST_UNAVAILABLE = 'Unable to retrieve genre list'
     DEVICE_INVALID_RESPONSE_CODE = 'Invalid response code received'
     DEVICE_INVALID_RESPONSE_TEXT = 'Invalid response content received'
     DEVICE_NON_EXISTENT_ERROR = 'Cannot continue. Device does not exist'
     DEVICE_NOT_REGISTERED_TEXT = 'Device is not registered, or does not have an active subscription'
+    DEVICE_PORTAL_TIMEOUT = 'Portal request did not complete in time, giving up'
+    DEVICE_PREWARM_COMPLETE = 'Devices have been loaded and their tasks scheduled'
+    DEVICE_RATE_LIMITED = 'Portal rate limit reached, delaying request'
+    DEVICE_REQUEST_FAILED = 'Portal request failed'
     DEVICE_RESPONSE_UNEXPECTED_JSON = 'Received unexpected JSON data'
     DEVICE_RESPONSE_NOT_JSON = 'Received a response which is not JSON'
+    DEVICE_SEGMENT_HANDLE_EXPIRED = 'Segment handle is unknown or has expired'
     DEVICE_STREAM_ID_NOT_FOUND = 'Stream ID does not exist'
     DEVICE_STREAM_SEGMENT_FAILED = 'Unable to retrieve stream segment'
     DEVICE_UNAVAILABLE = 'Unable to retrieve device, check device settings and try again'
@@ -40,6 +59,10 @@ class Locale(StrEnum):
     # Logging Localization
     LOG_FILE_NOT_FOUND = 'Could not find log file'
 
+    # Segment Cache Localization
+    SEGMENT_CACHE_UNAVAILABLE = 'Segment cache directory is unavailable, segments will not be cached'
+    SEGMENT_PREFETCH_FAILED = 'Unable to prefetch stream segment'
+
     # Task Localization
     TASK_CHANNEL_GUIDE_TRIGGERED = 'Manually triggered channel guide refresh'
     TASK_CONFLICTING_JOB_IGNORED = 'Scheduler conflicting ID error ignored'
@@ -47,6 +70,11 @@ class Locale(StrEnum):
     TASK_RUNNING_CHANNEL_GUIDE_REFRESH = 'Running device channel guide refresh task'
     TASK_RUNNING_CHANNEL_LIST_REFRESH = 'Running device channel list refresh task'
 
+    # Tuner Localization
+    TUNER_LEASE_LOST = 'Tuner lease was lost, stopping the channel broadcast'
+    TUNER_PREEMPTED = 'Idle tuner has been preempted by another channel'
+    TUNER_UNAVAILABLE = 'All tuners are in use'
+
     # User Interface Localization
     UI_USERNAME_CONTAINS_SPACES = "New username can't contain spaces"
     UI_USERNAME_DIDNT_CHANGE = 'The new username is the same as current'
@@ -0,0 +1,65 @@
+import os
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from magplex.utilities.variables import Environment
+
+
+class MediaClient:
+    """Process-wide pooled HTTP client for upstream media, connections are kept alive across requests."""
+    _session = None
+    _adapter = None
+    _pid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_session(cls):
+        """Lazily create the session, recreating it after a fork so sockets are never shared between processes."""
+        if cls._session is not None and cls._pid == os.getpid():
+            return cls._session
+        with cls._lock:
+            if cls._session is None or cls._pid != os.getpid():
+                adapter = HTTPAdapter(pool_connections=Environment.MEDIA_POOL_HOSTS,
+                                      pool_maxsize=Environment.MEDIA_POOL_SIZE, max_retries=0)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))  # Devices must not share cookies.
+                cls._adapter = adapter
+                cls._session = session
+                cls._pid = os.getpid()
+        return cls._session
+
+    @classmethod
+    def get(cls, url, headers=None, stream=False):
+        timeout = (Environment.MEDIA_CONNECT_TIMEOUT, Environment.MEDIA_READ_TIMEOUT)
+        return cls.get_session().get(url, headers=headers, stream=stream, timeout=timeout, allow_redirects=True)
+
+    @classmethod
+    def get_stats(cls):
+        """Connection pool usage for this worker, a request on a kept-alive connection counts as a hit."""
+        cls.get_session()
+        hosts = {}
+        pools = cls._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = f'{pool.scheme}://{pool.host}:{pool.port}'
+            hosts[host] = {
+                'requests': pool.num_requests,
+                'hits': max(0, pool.num_requests - pool.num_connections),
+                'misses': pool.num_connections,
+                'idle': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0
+            }
+
+        return {
+            'pid': cls._pid,
+            'requests': sum(host['requests'] for host in hosts.values()),
+            'hits': sum(host['hits'] for host in hosts.values()),
+            'misses': sum(host['misses'] for host in hosts.values()),
+            'hosts': hosts
+        }
@@ -0,0 +1,364 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from typing import BinaryIO
+
+from magplex.utilities.localization import Locale
+from magplex.utilities.media import MediaClient
+from magplex.utilities.variables import Environment
+
+
+@dataclass(slots=True)
+class SegmentClaim:
+    key: str
+    file: BinaryIO | None
+
+
+@dataclass(slots=True)
+class PrefetchState:
+    refreshed_at: float = 0
+    poll_timeout: float = 0
+    in_flight: set = field(default_factory=set)
+
+    def is_polled(self):
+        return time.monotonic() - self.refreshed_at <= self.poll_timeout
+
+
+class SegmentStore:
+    """Segment cache shared by every worker, held as files in shared memory under SEGMENT_CACHE_DIR.
+    A segment is written to a .part file by the one worker that claimed it, and renamed into place once complete.
+    Requests for a segment in flight attach to the .part file and follow it as it grows."""
+    CHUNK_SIZE = 64 * 1024
+    STALL_TIMEOUT = 15  # Seconds without growth before an in-flight segment is considered abandoned.
+    POLL_INTERVAL = 0.05
+    ACCEL_REDIRECT_PATH = '/internal/segments'  # Internal nginx location aliasing SEGMENT_CACHE_DIR.
+
+    _enabled = None
+    _pid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def is_enabled(cls):
+        if cls._pid == os.getpid():
+            return cls._enabled
+        with cls._lock:
+            if cls._pid != os.getpid():
+                enabled = Environment.SEGMENT_CACHE_SIZE > 0
+                if enabled:
+                    try:
+                        os.makedirs(Environment.SEGMENT_CACHE_DIR, exist_ok=True)
+                    except OSError:
+                        logging.warning(Locale.SEGMENT_CACHE_UNAVAILABLE(path=Environment.SEGMENT_CACHE_DIR))
+                        enabled = False
+                cls._enabled = enabled
+                cls._pid = os.getpid()
+        return cls._enabled
+
+    @classmethod
+    def get_key(cls, base_link, path):
+        return hashlib.sha256(f'{base_link}{path}'.encode()).hexdigest()[:32]
+
+    @classmethod
+    def get_path(cls, key):
+        return os.path.join(Environment.SEGMENT_CACHE_DIR, f'{key}.ts')
+
+    @classmethod
+    def _get_part_path(cls, key):
+        return os.path.join(Environment.SEGMENT_CACHE_DIR, f'{key}.ts.part')
+
+    @classmethod
+    def get_accel_redirect(cls, key):
+        return f'{cls.ACCEL_REDIRECT_PATH}/{key}.ts'
+
+    @classmethod
+    def touch(cls, key):
+        """Marks a completed segment as recently used, returns False when it isn't cached."""
+        try:
+            os.utime(cls.get_path(key))
+        except FileNotFoundError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    @classmethod
+    def open(cls, key):
+        """Opens a completed segment, marking it as recently used. Returns None when it isn't cached."""
+        try:
+            segment_file = open(cls.get_path(key), 'rb')
+        except FileNotFoundError:
+            return None
+        cls.touch(key)
+        return segment_file
+
+    @classmethod
+    def is_claimed(cls, key):
+        """Returns whether a request is fetching the segment."""
+        return os.path.exists(cls._get_part_path(key))
+
+    @classmethod
+    def claim(cls, key):
+        """Claims the segment for this request to fetch. Returns None when another request is already fetching it."""
+        part_path = cls._get_part_path(key)
+        for _ in range(2):
+            try:
+                fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                return SegmentClaim(key, os.fdopen(fd, 'wb', buffering=0))
+            except FileExistsError:
+                # Take over a claim that was abandoned by a worker which has since died.
+                try:
+                    if time.time() - os.stat(part_path).st_mtime < cls.STALL_TIMEOUT:
+                        return None
+                    os.unlink(part_path)
+                except FileNotFoundError:
+                    pass
+            except OSError:
+                return None
+        return None
+
+    @classmethod
+    def attach(cls, key):
+        """Attaches to a segment being fetched by another request, returning its chunks as they're written.
+        Returns None when the segment is neither in flight nor cached."""
+        try:
+            part_file = open(cls._get_part_path(key), 'rb')
+        except FileNotFoundError:
+            segment_file = cls.open(key)
+            return cls._read(segment_file) if segment_file is not None else None
+        return cls._tail(key, part_file)
+
+    @classmethod
+    def _read(cls, segment_file):
+        with segment_file:
+            yield from iter(lambda: segment_file.read(cls.CHUNK_SIZE), b'')
+
+    @classmethod
+    def attach_async(cls, key):
+        """Attaches to a segment being fetched by another request, for the event loop. The chunks are read without
+        blocking, and waited for with asyncio.sleep. Returns None when the segment isn't in flight."""
+        try:
+            part_file = open(cls._get_part_path(key), 'rb')
+        except FileNotFoundError:
+            return None
+        return cls._tail_async(key, part_file)
+
+    @classmethod
+    def _tail(cls, key, part_file):
+        chunks = cls._follow(key, part_file)
+        try:
+            for chunk in chunks:
+                if chunk is None:
+                    time.sleep(cls.POLL_INTERVAL)
+                    continue
+                yield chunk
+        finally:
+            chunks.close()
+
+    @classmethod
+    async def _tail_async(cls, key, part_file):
+        chunks = cls._follow(key, part_file)
+        try:
+            for chunk in chunks:
+                if chunk is None:
+                    await asyncio.sleep(cls.POLL_INTERVAL)
+                    continue
+                yield chunk
+        finally:
+            chunks.close()
+
+    @classmethod
+    def _follow(cls, key, part_file):
+        """Yields the chunks of a .part file as they're written, and None whenever the caller must wait for more."""
+        segment_path, part_path = cls.get_path(key), cls._get_part_path(key)
+        with part_file:
+            last_progress = time.monotonic()
+            while True:
+                chunk = part_file.read(cls.CHUNK_SIZE)
+                if chunk:
+                    last_progress = time.monotonic()
+                    yield chunk
+                    continue
+
+                # The rename only happens once every byte has been written, so drain the file and finish.
+                if os.path.exists(segment_path):
+                    yield from iter(lambda: part_file.read(cls.CHUNK_SIZE), b'')
+                    return
+                if not os.path.exists(part_path) or time.monotonic() - last_progress > cls.STALL_TIMEOUT:
+                    return
+                yield None
+
+    @classmethod
+    def fill(cls, claim, chunks):
+        """Passes the upstream chunks through while writing them to the claimed segment.
+        If the client goes away the segment is still completed, other requests may be attached to it."""
+        complete = False
+        try:
+            for chunk in chunks:
+                cls.write(claim, chunk)
+                yield chunk
+            complete = True
+        except GeneratorExit:
+            try:
+                for chunk in chunks:
+                    cls.write(claim, chunk)
+                complete = True
+            except Exception:
+                pass
+        finally:
+            if complete and claim.file is not None:
+                cls.commit(claim)
+            else:
+                cls.release(claim)
+
+    @classmethod
+    def write(cls, claim, chunk):
+        if claim.file is None:
+            return
+        try:
+            claim.file.write(chunk)
+        except OSError:
+            # Out of shared memory, keep serving the client without caching.
+            cls.release(claim)
+
+    @classmethod
+    def release(cls, claim):
+        """Abandons a claim, attached requests stop once the .part file is gone."""
+        if claim.file is None:
+            return
+        claim.file.close()
+        claim.file = None
+        try:
+            os.unlink(cls._get_part_path(claim.key))
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def commit(cls, claim):
+        """Completes a claim, the segment is then served from the cache by every worker."""
+        claim.file.close()
+        claim.file = None
+        try:
+            os.rename(cls._get_part_path(claim.key), cls.get_path(claim.key))
+        except FileNotFoundError:
+            return
+        cls.evict()
+
+    @classmethod
+    def evict(cls):
+        """Removes the least recently used segments until the cache fits its byte budget."""
+        budget = Environment.SEGMENT_CACHE_SIZE * 1024 * 1024
+        segments, total_size = [], 0
+        with os.scandir(Environment.SEGMENT_CACHE_DIR) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                total_size += stat.st_size
+                if entry.name.endswith('.ts'):
+                    segments.append((stat.st_mtime, stat.st_size, entry.path))
+
+        segments.sort()
+        for _, size, segment_path in segments:
+            if total_size <= budget:
+                break
+            try:
+                os.unlink(segment_path)  # Requests already reading the segment keep their open file.
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+class SegmentPrefetcher:
+    """Fetches the newest segments of a served playlist into the segment store, ahead of the player asking for them.
+    Segments are claimed in the store before they're queued, so a segment is only fetched once across every worker.
+    A channel counts as polled while this worker keeps refreshing its playlist, queued and running fetches of a
+    channel which is no longer polled are dropped."""
+    MAX_WORKERS = 8
+    MAX_QUEUED = MAX_WORKERS * 2  # Fetches in flight across every channel, so a backlog can't build up.
+    POLL_TIMEOUT_FACTOR = 3  # Target durations without a playlist refresh before the channel counts as idle.
+
+    _executor = None
+    _pid = None
+    _channels = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def is_enabled(cls):
+        return Environment.SEGMENT_PREFETCH > 0 and SegmentStore.is_enabled()
+
+    @classmethod
+    def _get_executor(cls):
+        if cls._executor is None or cls._pid != os.getpid():
+            cls._executor = ThreadPoolExecutor(max_workers=cls.MAX_WORKERS, thread_name_prefix='segment-prefetch')
+            cls._pid = os.getpid()
+            cls._channels = {}
+        return cls._executor
+
+    @classmethod
+    def prefetch(cls, channel_key, segments, target_duration):
+        """Queues the newest segments of a channel playlist, at most SEGMENT_PREFETCH claimed by this worker are in
+        flight per channel, and MAX_QUEUED overall. Segments which are cached or claimed by any other request are
+        skipped."""
+        with cls._lock:
+            executor = cls._get_executor()
+            state = cls._channels.get(channel_key)
+            if state is None:
+                state = cls._channels[channel_key] = PrefetchState()
+            state.refreshed_at = time.monotonic()
+            state.poll_timeout = target_duration * cls.POLL_TIMEOUT_FACTOR
+
+            queued = sum(len(channel_state.in_flight) for channel_state in cls._channels.values())
+            for data in segments[-Environment.SEGMENT_PREFETCH:]:
+                if len(state.in_flight) >= Environment.SEGMENT_PREFETCH or queued >= cls.MAX_QUEUED:
+                    break
+                segment_key = SegmentStore.get_key(data.get('base_link'), data.get('path'))
+                if segment_key in state.in_flight or os.path.exists(SegmentStore.get_path(segment_key)):
+                    continue
+                if SegmentStore.is_claimed(segment_key):
+                    continue
+                claim = SegmentStore.claim(segment_key)
+                if claim is None:
+                    continue
+                state.in_flight.add(segment_key)
+                queued += 1
+                executor.submit(cls._fetch, channel_key, state, claim, data)
+
+            # Forget the channels nobody is watching anymore.
+            for key, channel_state in list(cls._channels.items()):
+                if not channel_state.in_flight and not channel_state.is_polled():
+                    del cls._channels[key]
+
+    @classmethod
+    def _fetch(cls, channel_key, state, claim, data):
+        try:
+            if not state.is_polled():
+                SegmentStore.release(claim)
+                return
+
+            session_identifier = data.get('session_identifier')
+            headers = {"X-Sid": session_identifier} if session_identifier else {}
+            r = MediaClient.get(f"{data.get('base_link')}{data.get('path')}", headers=headers, stream=True)
+            with r:
+                if r.status_code != HTTPStatus.OK:
+                    SegmentStore.release(claim)
+                    return
+                for chunk in r.iter_content(chunk_size=SegmentStore.CHUNK_SIZE):
+                    if not state.is_polled():
+                        SegmentStore.release(claim)  # Nobody is watching the channel anymore.
+                        return
+                    SegmentStore.write(claim, chunk)
+                if claim.file is not None:
+                    SegmentStore.commit(claim)
+        except Exception:
+            SegmentStore.release(claim)
+            logging.debug(Locale.SEGMENT_PREFETCH_FAILED(channel=channel_key[1]))
+        finally:
+            with cls._lock:
+                state.in_flight.discard(claim.key)
@@ -5,6 +5,7 @@ from pathlib import Path
 
 from dotenv import load_dotenv
 
+from magplex.utilities import sanitizer
 from version import version
 
 base_directory = Path(__file__).resolve().parent.parent.parent
@@ -26,6 +27,30 @@ class Environment:
     BASE_FFMPEG = os.getenv('FFMPEG', None) or shutil.which('ffmpeg')
     BASE_CODEC = os.getenv('CODEC', False)
 
+    MAX_DEVICES = int(os.getenv('MAX_DEVICES', 100))
+    DEVICE_IDLE_TIMEOUT = int(os.getenv('DEVICE_IDLE_TIMEOUT', 3600))
+
+    PORTAL_CONCURRENCY = int(os.getenv('PORTAL_CONCURRENCY', 5))
+    PORTAL_RATE_LIMIT = float(os.getenv('PORTAL_RATE_LIMIT', 5))
+    PORTAL_RATE_BURST = int(os.getenv('PORTAL_RATE_BURST', 10))
+
+    GATEWAY_PORT = int(os.getenv('GATEWAY_PORT', 8001))
+    BROADCAST_BUFFER_SIZE = int(os.getenv('BROADCAST_BUFFER_SIZE', 16))
+    BROADCAST_GRACE_PERIOD = float(os.getenv('BROADCAST_GRACE_PERIOD', 10))
+    TUNER_COUNT = max(1, int(os.getenv('TUNER_COUNT', 1)))
+    TUNER_PREEMPTION = sanitizer.sanitize_bool(os.getenv('TUNER_PREEMPTION', False))
+
+    MEDIA_POOL_HOSTS = int(os.getenv('MEDIA_POOL_HOSTS', 20))
+    MEDIA_POOL_SIZE = int(os.getenv('MEDIA_POOL_SIZE', 10))
+    MEDIA_CONNECT_TIMEOUT = float(os.getenv('MEDIA_CONNECT_TIMEOUT', 5))
+    MEDIA_READ_TIMEOUT = float(os.getenv('MEDIA_READ_TIMEOUT', 15))
+
+    SEGMENT_CACHE_DIR = os.getenv('SEGMENT_CACHE_DIR', '/dev/shm/magplex/segments')
+    SEGMENT_CACHE_SIZE = int(os.getenv('SEGMENT_CACHE_SIZE', 48))
+    SEGMENT_ACCEL_REDIRECT = sanitizer.sanitize_bool(os.getenv('SEGMENT_ACCEL_REDIRECT', False))
+    SEGMENT_HANDLES = sanitizer.sanitize_bool(os.getenv('SEGMENT_HANDLES', False))
+    SEGMENT_PREFETCH = int(os.getenv('SEGMENT_PREFETCH', 0))
+
     DEBUG = os.getenv('DEBUG', False)
 
     @classmethod